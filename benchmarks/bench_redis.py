@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# redis connections shared by the benchmark scripts, run them
+# from the repository root, for example:
+#
+#     python benchmarks/numerate.py --db-port 6379
+#     python benchmarks/numerate.py --fake
+#
+# --fake uses fakeredis (pip install fakeredis) so that no
+# server is needed. Round trips are then in process, which
+# understates the savings of pipelining.
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--db-host", default="127.0.0.1", help="db host ip")
+    parser.add_argument("--db-port", default=6379, type=int, help="db port")
+    parser.add_argument(
+        "--fake", action="store_true", help="use fakeredis instead of a server"
+    )
+    return parser
+
+
+def connections(args):
+    # returns (redis_conn, binary_r) like the keli pipes
+    if args.fake:
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        return (
+            fakeredis.FakeStrictRedis(server=server, decode_responses=True),
+            fakeredis.FakeStrictRedis(server=server),
+        )
+    import redis
+
+    return (
+        redis.StrictRedis(host=args.db_host, port=args.db_port, decode_responses=True),
+        redis.StrictRedis(host=args.db_host, port=args.db_port),
+    )
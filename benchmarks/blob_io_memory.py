@@ -0,0 +1,133 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# peak RSS of blob reads and writes using the copies made before
+# blob_io (baseline) and using blob_io. Each case runs in a fresh
+# process, peak RSS is reset through /proc/self/clear_refs so
+# this needs linux.
+#
+#     python benchmarks/blob_io_memory.py --fake --size 50
+
+import io
+import os
+import tempfile
+import multiprocessing
+import bench_redis
+from keli import blob_io
+
+KEY = "keli_bench:blob"
+
+
+def rss(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+
+
+def reset_peak():
+    # resets VmHWM to the current RSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def open_image_read_baseline(binary_r, data, path):
+    key_bytes = binary_r.get(KEY)
+    file = io.BytesIO()
+    file.write(key_bytes)
+    return file
+
+
+def open_image_read_blob_io(binary_r, data, path):
+    return io.BytesIO(blob_io.read_blob(binary_r, KEY))
+
+
+def open_image_write_baseline(binary_r, data, path):
+    # image.save(file) then seek and read back
+    file = io.BytesIO()
+    file.write(data)
+    file.seek(0)
+    binary_r.set(KEY, file.read())
+
+
+def open_image_write_blob_io(binary_r, data, path):
+    file = io.BytesIO()
+    file.write(data)
+    with file.getbuffer() as view:
+        blob_io.write_blob(binary_r, KEY, view)
+
+
+def artifact_baseline(binary_r, data, path):
+    artifact_bytes = binary_r.get(KEY)
+    with open(path, "wb+") as file:
+        file.write(artifact_bytes)
+
+
+def artifact_blob_io(binary_r, data, path):
+    blob_io.blob_to_file(binary_r, KEY, path)
+
+
+def file_bytes_baseline(binary_r, data, path):
+    with open(path, "rb") as f:
+        contents = io.BytesIO(f.read())
+    return contents.getvalue()
+
+
+def file_bytes_blob_io(binary_r, data, path):
+    return blob_io.file_bytes(path)
+
+
+CASES = [
+    ("open_image read", open_image_read_baseline, open_image_read_blob_io),
+    ("open_image write", open_image_write_baseline, open_image_write_blob_io),
+    ("src_artifact", artifact_baseline, artifact_blob_io),
+    ("slurp file_bytes", file_bytes_baseline, file_bytes_blob_io),
+]
+
+
+def run_case(args, case, size, results):
+    redis_conn, binary_r = bench_redis.connections(args)
+    # write the stored blob and file in chunks so that setup
+    # does not raise the peak above what the case itself uses
+    chunk = bytes(blob_io.CHUNK_SIZE)
+    chunks = size // len(chunk)
+    blob_io.write_blob_chunks(binary_r, KEY, (chunk for _ in range(chunks)))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "blob")
+        with open(path, "wb") as f:
+            for _ in range(chunks):
+                f.write(chunk)
+        data = bytes(chunks * len(chunk)) if "write" in case.__name__ else None
+        before = rss("VmRSS")
+        reset_peak()
+        kept = case(binary_r, data, path)
+        results.put(rss("VmHWM") - before)
+        del kept
+    binary_r.delete(KEY)
+
+
+def main():
+    parser = bench_redis.parser("peak RSS of blob io")
+    parser.add_argument("--size", default=50, type=int, help="blob size in MB")
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+
+    print("{:<18} {:>14} {:>14}".format("path", "baseline MB", "blob_io MB"))
+    for name, baseline, blob_io_case in CASES:
+        peaks = []
+        for case in (baseline, blob_io_case):
+            process = context.Process(target=run_case, args=(args, case, size, results))
+            process.start()
+            peaks.append(results.get() / 1024 / 1024)
+            process.join()
+        print("{:<18} {:>14.1f} {:>14.1f}".format(name, *peaks))
+    print("peak RSS growth for a {} MB blob".format(args.size))
+
+
+if __name__ == "__main__":
+    main()
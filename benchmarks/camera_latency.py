@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# gphoto2 capture latency initializing and exiting the camera
+# for every shot, as slurpd did, compared with CameraSession
+# keeping it initialized. gphoto2 is replaced by a stub that
+# sleeps for the given init and capture times, so no camera
+# is needed. --disconnect fails the capture after that many
+# shots once, like a camera unplugged and plugged back in.
+#
+#     python benchmarks/camera_latency.py --shots 10 --init 1.5
+
+import os
+import sys
+import time
+import types
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class GPhoto2Error(Exception):
+    pass
+
+
+class Camera(object):
+    def set_port_info(self, port_info):
+        pass
+
+
+class PortInfoList(list):
+    def load(self):
+        self.append("usb:001,002")
+
+    def lookup_path(self, address):
+        return self.index(address)
+
+
+def stub_gphoto2(init, capture, disconnect):
+    gp = types.ModuleType("gphoto2")
+    gp.stats = {"inits": 0, "shots": 0, "failed": False}
+    gp.GPhoto2Error = GPhoto2Error
+    gp.GP_CAPTURE_IMAGE = 0
+    gp.GP_FILE_TYPE_NORMAL = 1
+    gp.Camera = Camera
+    gp.PortInfoList = PortInfoList
+    gp.gp_context_new = object
+    gp.check_result = lambda result: result
+
+    def gp_camera_init(camera, context):
+        time.sleep(init)
+        gp.stats["inits"] += 1
+
+    def gp_camera_capture(camera, capture_type, context):
+        if gp.stats["shots"] == disconnect and not gp.stats["failed"]:
+            gp.stats["failed"] = True
+            raise GPhoto2Error("I/O in progress")
+        time.sleep(capture)
+        gp.stats["shots"] += 1
+        return types.SimpleNamespace(folder="/", name="capt0000.jpg")
+
+    gp.gp_camera_init = gp_camera_init
+    gp.gp_camera_capture = gp_camera_capture
+    gp.gp_camera_file_get = lambda *args: bytearray(1024)
+    gp.gp_file_get_data_and_size = lambda captured_file: captured_file
+    gp.gp_camera_exit = lambda camera, context: None
+    sys.modules["gphoto2"] = gp
+    return gp
+
+
+def capture_per_shot(gp, address):
+    # slurpd before CameraSession
+    context = gp.gp_context_new()
+    camera = gp.Camera()
+    cameras = gp.PortInfoList()
+    cameras.load()
+    camera_address = cameras.lookup_path(address)
+    camera.set_port_info(cameras[camera_address])
+    gp.check_result(gp.gp_camera_init(camera, context))
+    captured = gp.check_result(
+        gp.gp_camera_capture(camera, gp.GP_CAPTURE_IMAGE, context)
+    )
+    captured_file = gp.check_result(
+        gp.gp_camera_file_get(
+            camera, captured.folder, captured.name, gp.GP_FILE_TYPE_NORMAL, context
+        )
+    )
+    contents = memoryview(gp.check_result(gp.gp_file_get_data_and_size(captured_file)))
+    gp.check_result(gp.gp_camera_exit(camera, context))
+    return contents
+
+
+def timed(gp, capture, shots):
+    gp.stats.update(inits=0, shots=0, failed=False)
+    latencies = []
+    while gp.stats["shots"] < shots:
+        start = time.perf_counter()
+        try:
+            capture()
+        except GPhoto2Error as ex:
+            # slurpd prints the error and the shot is retaken
+            print(ex)
+        latencies.append(time.perf_counter() - start)
+    return gp.stats["inits"], sum(latencies) / len(latencies), max(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gphoto2 capture latency")
+    parser.add_argument("--shots", default=10, type=int)
+    parser.add_argument("--init", default=1.5, type=float, help="init seconds")
+    parser.add_argument("--capture", default=0.5, type=float, help="capture seconds")
+    parser.add_argument(
+        "--disconnect", default=5, type=int, help="shot to fail once, -1 for none"
+    )
+    args = parser.parse_args()
+
+    gp = stub_gphoto2(args.init, args.capture, args.disconnect)
+    from keli.camera_session import CameraSession
+
+    address = "usb:001,002"
+    session = CameraSession()
+    per_shot = timed(gp, lambda: capture_per_shot(gp, address), args.shots)
+    kept = timed(gp, lambda: session.capture(address), args.shots)
+    session.close()
+
+    print(
+        "{} shots, {} s init, {} s capture".format(args.shots, args.init, args.capture)
+    )
+    print("{:<20} {:>6} {:>10} {:>10}".format("path", "inits", "mean s", "max s"))
+    print("{:<20} {:>6} {:>10.3f} {:>10.3f}".format("init per shot", *per_shot))
+    print("{:<20} {:>6} {:>10.3f} {:>10.3f}".format("CameraSession", *kept))
+
+
+if __name__ == "__main__":
+    main()
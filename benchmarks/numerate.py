@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# src-numerate-to-one renumbering from the end of a structured
+# sequence, using the position index and one pipelined batch,
+# compared with the full LRANGE, list.index and one HSET per
+# item it replaced
+#
+#     python benchmarks/numerate.py --fake --items 10000
+
+import time
+import bench_redis
+from keli import src_pipe
+
+SEQUENCE = "keli_bench:sequence"
+FIELD = "page_number"
+
+
+def numerate_to_one_baseline(redis_conn, context, structured_sequence, start_at):
+    structured = redis_conn.lrange(structured_sequence, 0, -1)
+    starting_position = structured.index(context["uuid"])
+    starting_value = int(start_at)
+    to_numerate = structured[
+        starting_position - (starting_value - 1) : starting_position
+    ][::-1]
+    for source_num, source in enumerate(to_numerate):
+        redis_conn.hset(source, context["key"], (starting_value - source_num - 1))
+
+
+def numbers(redis_conn, items):
+    pipe = redis_conn.pipeline(transaction=False)
+    for item in items:
+        pipe.hget(item, FIELD)
+    return pipe.execute()
+
+
+def main():
+    parser = bench_redis.parser("src-numerate-to-one on a long sequence")
+    parser.add_argument("--items", default=10000, type=int)
+    args = parser.parse_args()
+
+    src = src_pipe.keli_src(db_host=args.db_host, db_port=args.db_port)
+    src.redis_conn, src.binary_r = bench_redis.connections(args)
+    items = ["keli_bench:glworb:{}".format(i) for i in range(args.items)]
+    src.redis_conn.delete(SEQUENCE, *items)
+    src.redis_conn.rpush(SEQUENCE, *items)
+    context = {"uuid": items[-1], "key": FIELD}
+
+    start = time.perf_counter()
+    numerate_to_one_baseline(src.redis_conn, dict(context), SEQUENCE, args.items)
+    baseline = time.perf_counter() - start
+    expected = numbers(src.redis_conn, items)
+    src.redis_conn.delete(*items)
+
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        src.src_numerate_to_one(dict(context), SEQUENCE, start_at=args.items)
+        timings.append(time.perf_counter() - start)
+    assert numbers(src.redis_conn, items) == expected
+
+    print("{} items, renumbering from the end".format(args.items))
+    print("lrange/index/hset per item {:8.3f} s".format(baseline))
+    print("indexed, building index    {:8.3f} s".format(timings[0]))
+    print("indexed                    {:8.3f} s".format(timings[1]))
+    src.redis_conn.delete(
+        SEQUENCE, src_pipe.SEQUENCE_INDEX_TEMPLATE.format(SEQUENCE), *items
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# img-rotate by 90 degrees decoding, rotating and encoding the
+# pixels compared with rewriting the exif orientation tag
+#
+#     python benchmarks/rotate.py --fake --width 6000 --height 4000
+
+import io
+import time
+import bench_redis
+from PIL import Image
+from keli import img_pipe
+
+UUID = "keli_bench:glworb"
+KEY = "binary_key"
+BLOB = "keli_bench:binary"
+
+
+def capture(width, height):
+    # noise so that the jpeg has a realistic size
+    bands = [Image.effect_noise((width, height), 64) for _ in range(3)]
+    file = io.BytesIO()
+    Image.merge("RGB", bands).save(file, "JPEG", quality=90)
+    return file.getvalue()
+
+
+def reset(img, data):
+    img.redis_conn.delete(UUID)
+    img.redis_conn.hset(UUID, KEY, BLOB)
+    img.binary_r.set(BLOB, data)
+    img_pipe.blob_written(img.redis_conn, BLOB)
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = bench_redis.parser("img-rotate pixel and exif paths")
+    parser.add_argument("--width", default=6000, type=int)
+    parser.add_argument("--height", default=4000, type=int)
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    img = img_pipe.keli_img(db_host=args.db_host, db_port=args.db_port)
+    img.redis_conn, img.binary_r = bench_redis.connections(args)
+    context = {"uuid": UUID, "key": KEY}
+    data = capture(args.width, args.height)
+    print("{}x{} jpeg, {} bytes".format(args.width, args.height, len(data)))
+
+    reset(img, data)
+    pixels = timed(lambda: img.img_rotate(dict(context), 90), args.repeat)
+    reset(img, data)
+    exif = timed(lambda: img.img_rotate(dict(context), 90, exif=True), args.repeat)
+    # the exif rotation is applied when the pixels are next needed
+    img_pipe.image_cache.clear()
+    start = time.perf_counter()
+    with img._open(UUID, KEY, mode=img_pipe.READ) as handle:
+        size = handle.image.size
+    applied = time.perf_counter() - start
+
+    print("decode/rotate/encode  {:8.3f} s per rotation".format(pixels))
+    print("exif orientation      {:8.3f} s per rotation".format(exif))
+    print("first open after exif {:8.3f} s, {}".format(applied, size))
+    img.redis_conn.delete(UUID, BLOB)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# keli startup time, each command runs in a fresh interpreter
+# and the median wall time is compared with the target for
+# keli list. Signature lookup imports the command's module, so
+# it needs PIL, tesserocr, redis and the other dependencies.
+#
+#     python benchmarks/startup.py --repeat 20 --target 150
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def timed(command, repeat):
+    # returns the median milliseconds or the error of a failure
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        done = subprocess.run(
+            command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        times.append(time.perf_counter() - start)
+        if done.returncode:
+            return done.stderr.decode().strip().splitlines()[-1]
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="keli startup time")
+    parser.add_argument("--repeat", default=20, type=int)
+    parser.add_argument("--target", default=150, type=float, help="keli list ms")
+    args = parser.parse_args()
+
+    from keli.commands import COMMANDS, command_names
+
+    names = list(command_names())
+    keli = [sys.executable, "-m", "keli.keli_cli"]
+    cases = [("python -c pass", [sys.executable, "-c", "pass"])]
+    cases.append(("keli list", keli + ["list"]))
+    # signature lookup of the first command of each pipe
+    for prefix in COMMANDS:
+        name = next(n for n in names if n.startswith(prefix + "-"))
+        cases.append(("keli {}".format(name), keli + [name]))
+
+    results = {}
+    for label, command in cases:
+        results[label] = timed(command, args.repeat)
+        if isinstance(results[label], str):
+            print("{:<24} failed, {}".format(label, results[label]))
+        else:
+            print("{:<24} {:8.1f} ms".format(label, results[label]))
+    if not isinstance(results["keli list"], str):
+        met = "meets" if results["keli list"] < args.target else "misses"
+        print("keli list {} the {} ms target".format(met, args.target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import uuid
+import hashlib
+
+# blobs larger than this are streamed with GETRANGE / APPEND
+# in chunks instead of a single GET / SET
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# prefix for keys that chunked writes are assembled in before
+# being renamed into place, kept outside of binary:* so that
+# partial blobs are never matched by prune patterns
+PARTIAL_PREFIX = "keli:partial:"
+
+# hash of binary key to content version, incremented
+# whenever keli writes to a binary key. Used to check
+# that a cached decode still matches the stored bytes
+# without fetching them.
+BINARY_VERSIONS_KEY = "keli:binary_versions"
+
+
+def read_blob(binary_r, key):
+    # single GET, the returned bytes can be wrapped with
+    # io.BytesIO or memoryview without being copied
+    return binary_r.get(key)
+
+
+def iter_blob(binary_r, key, chunk_size=CHUNK_SIZE):
+    # yield blob contents in chunks using GETRANGE
+    length = binary_r.strlen(key)
+    for start in range(0, length, chunk_size):
+        yield binary_r.getrange(key, start, min(start + chunk_size, length) - 1)
+
+
+def write_blob(binary_r, key, data, chunk_size=CHUNK_SIZE):
+    """Write bytes-like data to key
+
+    data may be bytes, bytearray or a memoryview such as
+    BytesIO.getbuffer(); it is sliced with memoryview so no
+    intermediate copies are made.
+    """
+    view = memoryview(data)
+    if view.nbytes <= chunk_size:
+        binary_r.set(key, view)
+    else:
+        write_blob_chunks(
+            binary_r,
+            key,
+            (
+                view[start : start + chunk_size]
+                for start in range(0, view.nbytes, chunk_size)
+            ),
+        )
+    return view.nbytes
+
+
+def write_blob_chunks(binary_r, key, chunks):
+    # assemble chunks with APPEND under a partial key then
+    # rename so that readers never see an incomplete blob
+    partial_key = PARTIAL_PREFIX + key
+    binary_r.delete(partial_key)
+    written = 0
+    for chunk in chunks:
+        binary_r.append(partial_key, chunk)
+        written += len(chunk)
+    if written:
+        binary_r.rename(partial_key, key)
+    else:
+        binary_r.set(key, b"")
+    return written
+
+
+def blob_to_file(binary_r, key, file, chunk_size=CHUNK_SIZE):
+    # stream a blob to a path or writable file object
+    if hasattr(file, "write"):
+        written = 0
+        for chunk in iter_blob(binary_r, key, chunk_size=chunk_size):
+            written += file.write(chunk)
+        return written
+    with open(file, "wb+") as f:
+        return blob_to_file(binary_r, key, f, chunk_size=chunk_size)
+
+
+def file_bytes(filename, delete_file=False):
+    # read a file with a single copy into bytes
+    with open(filename, "rb") as f:
+        contents = f.read()
+    if delete_file:
+        os.remove(filename)
+    return contents
+
+
+# hash of blob key to the number of hash fields referencing it
+BLOB_REFS = "keli:blob_refs"
+# set of blob keys that may have lost their last reference,
+# the only blobs neo_prune needs to visit
+BLOB_CANDIDATES = "keli:blob_candidates"
+
+
+def blob_ref(redis_conn, blob_key):
+    # record a new reference, redis_conn may be a pipeline
+    redis_conn.hincrby(BLOB_REFS, blob_key, 1)
+
+
+def blob_unref(redis_conn, blob_key):
+    redis_conn.hincrby(BLOB_REFS, blob_key, -1)
+    redis_conn.sadd(BLOB_CANDIDATES, blob_key)
+
+
+# blobs are keyed by the sha256 of their contents when the
+# environment variable is set, identical bytes are then
+# stored once and shared by every field referencing them
+CONTENT_ADDRESSED_ENV = "KELI_CONTENT_ADDRESSED"
+CONTENT_PREFIX = "sha256:"
+DEDUP_STATS = "keli:dedup_stats"
+
+
+def content_addressed():
+    return os.environ.get(CONTENT_ADDRESSED_ENV, "0") not in ("", "0")
+
+
+def is_content_key(blob_key):
+    # content addressed blobs are shared and must never be
+    # written in place
+    return CONTENT_PREFIX in blob_key
+
+
+def store_blob(
+    binary_r, redis_conn, data, key_prefix="binary:", content_addressed_key=None
+):
+    """Store data as a new referenced blob and return its key
+
+    With content addressed keys the write is skipped if a blob
+    with the same digest already exists and only a reference
+    is added. Otherwise the key is a random uuid. redis_conn
+    may be a pipeline, binary_r must not be one when content
+    addressing since the reference is added and existing blobs
+    are checked through it immediately.
+    """
+    if content_addressed_key is None:
+        content_addressed_key = content_addressed()
+    view = memoryview(data)
+    if content_addressed_key:
+        blob_key = "{}{}{}".format(
+            key_prefix, CONTENT_PREFIX, hashlib.sha256(view).hexdigest()
+        )
+        # reference through binary_r, not a possibly queued
+        # redis_conn, before checking. A prune deleting the blob
+        # afterwards then fails its watch on the counts and
+        # retries, one deleting it before makes exists false.
+        blob_ref(binary_r, blob_key)
+        if binary_r.exists(blob_key):
+            redis_conn.hincrby(DEDUP_STATS, "deduplicated", 1)
+            redis_conn.hincrby(DEDUP_STATS, "bytes_saved", view.nbytes)
+            return blob_key
+        write_blob(binary_r, blob_key, view)
+    else:
+        blob_key = "{}{}".format(key_prefix, uuid.uuid4())
+        write_blob(binary_r, blob_key, view)
+        blob_ref(redis_conn, blob_key)
+    redis_conn.hincrby(DEDUP_STATS, "written", 1)
+    redis_conn.hincrby(DEDUP_STATS, "bytes_written", view.nbytes)
+    return blob_key
+
+
+def dedup_stats(redis_conn):
+    stats = {"written": 0, "deduplicated": 0, "bytes_written": 0, "bytes_saved": 0}
+    for k, v in redis_conn.hgetall(DEDUP_STATS).items():
+        stats[k] = int(v)
+    stores = stats["written"] + stats["deduplicated"]
+    stats["dedup_ratio"] = stats["deduplicated"] / stores if stores else 0.0
+    return stats
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import atexit
+import threading
+import collections
+import gphoto2 as gp
+
+
+class CameraSession(object):
+    """Process-wide gphoto2 cameras kept initialized
+
+    Cameras are initialized by address on first capture and
+    reused by later captures instead of being initialized and
+    exited for every shot. A capture that fails, for example
+    because the camera was unplugged and plugged back in,
+    closes the camera and is retried once with a fresh init.
+
+    Captures on one address are serialized, different addresses
+    can be captured concurrently.
+    """
+
+    def __init__(self):
+        self.cameras = {}
+        self.locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def _address_lock(self, address):
+        with self.lock:
+            return self.locks[address]
+
+    def _open(self, address):
+        context = gp.gp_context_new()
+        camera = gp.Camera()
+        cameras = gp.PortInfoList()
+        cameras.load()
+        camera_address = cameras.lookup_path(address)
+        camera.set_port_info(cameras[camera_address])
+        gp.check_result(gp.gp_camera_init(camera, context))
+        return camera, context
+
+    def _close(self, address):
+        camera, context = self.cameras.pop(address, (None, None))
+        if camera is not None:
+            try:
+                gp.gp_camera_exit(camera, context)
+            except gp.GPhoto2Error as ex:
+                print(ex)
+
+    def capture(self, address):
+        # returns the captured file as a memoryview
+        with self._address_lock(address):
+            for attempt in range(2):
+                try:
+                    if address not in self.cameras:
+                        self.cameras[address] = self._open(address)
+                    return self._capture(*self.cameras[address])
+                except gp.GPhoto2Error:
+                    self._close(address)
+                    if attempt:
+                        raise
+
+    def _capture(self, camera, context):
+        captured = gp.check_result(
+            gp.gp_camera_capture(camera, gp.GP_CAPTURE_IMAGE, context)
+        )
+
+        captured_file = gp.check_result(
+            gp.gp_camera_file_get(
+                camera, captured.folder, captured.name, gp.GP_FILE_TYPE_NORMAL, context
+            )
+        )
+
+        captured_file_data = gp.check_result(
+            gp.gp_file_get_data_and_size(captured_file)
+        )
+        # hand off the camera file buffer without copying it,
+        # the memoryview keeps the underlying data alive
+        return memoryview(captured_file_data)
+
+    def close(self):
+        for address in list(self.cameras):
+            with self._address_lock(address):
+                self._close(address)
+
+
+camera_session = CameraSession()
+atexit.register(camera_session.close)
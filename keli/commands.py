@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import re
+import importlib
+import importlib.util
+
+# command prefix to the module and class implementing commands
+# with that prefix, for example img-rotate is keli_img.img_rotate.
+# Only the module of the command being run is imported.
+COMMANDS = {
+    "img": ("keli.img_pipe", "keli_img"),
+    "src": ("keli.src_pipe", "keli_src"),
+    "neo": ("keli.neo_pipe", "keli_neo"),
+}
+
+
+def method_name(command):
+    return command.replace("-", "_")
+
+
+def command_class(command):
+    # raises KeyError for commands without a known prefix
+    module, class_name = COMMANDS[command.partition("-")[0]]
+    return getattr(importlib.import_module(module), class_name)
+
+
+def command_names():
+    """Names of all commands, without importing any pipe
+
+    The method names are read from the module source so that
+    listing commands does not load PIL, tesserocr or redis.
+    Matching the class body and its method definitions is
+    several times faster than parsing the source.
+    """
+    for prefix, (module, class_name) in COMMANDS.items():
+        with open(importlib.util.find_spec(module).origin) as f:
+            source = f.read()
+        # the class body ends at the next unindented line
+        body = re.search(
+            r"^class {}\b.*?(?=^\S|\Z)".format(class_name), source, re.M | re.S
+        )
+        for name in re.findall(
+            r"^    def ({}_\w+)\(".format(prefix), body.group(), re.M
+        ):
+            yield name.replace("_", "-")
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import json
+import datetime
+
+# hash of device address to device dict for a slurp method
+DEVICE_REGISTRY_TEMPLATE = "device:registry:{}"
+# present while the registry of a slurp method is fresh
+DEVICE_REGISTRY_FRESH_TEMPLATE = "device:registry:{}:fresh"
+# seconds discovered devices are used without discovering again
+DEVICE_REGISTRY_TTL = int(os.environ.get("KELI_DEVICE_TTL", 60))
+
+
+class DeviceRegistry(object):
+    """Discovered devices of a slurp method kept in redis
+
+    Devices are stored by address. Within ttl seconds of the
+    last refresh the stored devices are returned without any
+    discovery. A refresh only probes addresses that are not
+    yet known, such as a camera that was just plugged in, and
+    drops devices that are no longer present.
+    """
+
+    def __init__(self, redis_conn, method, ttl=DEVICE_REGISTRY_TTL):
+        self.redis_conn = redis_conn
+        self.key = DEVICE_REGISTRY_TEMPLATE.format(method)
+        self.fresh_key = DEVICE_REGISTRY_FRESH_TEMPLATE.format(method)
+        self.ttl = ttl
+
+    def devices(self):
+        # stored devices or None if the registry is stale
+        if not self.redis_conn.exists(self.fresh_key):
+            return None
+        return self._sorted(self.redis_conn.hgetall(self.key))
+
+    def refresh(self, found, probe=None):
+        """Update the registry from found devices
+
+            Args:
+                found(dict): address to device dict of every
+                    device currently present
+                probe: called with a device dict for addresses
+                    not in the registry, returns the dict with
+                    details that are slow to look up such as
+                    a serial number, or None to skip the device
+
+            Returns:
+                list: device dicts
+        """
+        known = self.redis_conn.hgetall(self.key)
+        now = str(datetime.datetime.now())
+        devices = {}
+        for address, device in found.items():
+            if address in known and probe is not None:
+                device = json.loads(known[address])
+            elif probe is not None:
+                # skipped devices are probed again next refresh
+                device = probe(device)
+                if device is None:
+                    continue
+            device["lastseen"] = now
+            devices[address] = json.dumps(device)
+
+        pipe = self.redis_conn.pipeline()
+        pipe.delete(self.key)
+        if devices:
+            pipe.hmset(self.key, devices)
+        pipe.set(self.fresh_key, now, ex=self.ttl)
+        pipe.execute()
+        return self._sorted(devices)
+
+    def invalidate(self):
+        self.redis_conn.delete(self.fresh_key)
+
+    @staticmethod
+    def _sorted(devices):
+        return [json.loads(devices[address]) for address in sorted(devices)]
@@ -6,53 +6,520 @@
 
 import redis
 import io
-import uuid
+import os
+import hashlib
+import threading
+import collections
+import json
+import shlex
+import time
+import multiprocessing
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 from tesserocr import PyTessBaseAPI, PSM, image_to_text, OEM, RIL
 from logzero import logger
 from lings.routeling import route_broadcast
 
 from ma_cli import data_models
+from keli.tesseract_pool import tesseract_pool
+from keli.blob_io import (
+    read_blob,
+    write_blob,
+    blob_unref,
+    store_blob,
+    content_addressed,
+    is_content_key,
+    CONTENT_PREFIX,
+    BINARY_VERSIONS_KEY,
+)
+from keli.previews import PREVIEW_SIZE, preview_field, reduced_image
+from keli import jpeg_exif
+from keli.ocr_cache import OcrCache
+from keli.ocr_index import pack_boxes, BoxIndex
+
+
+class ImageCache(object):
+    """Bounded in-process cache of decoded images
+
+    Entries are keyed by binary key, content version and
+    variant, such as the size of a reduced decode, and evicted
+    least recently used first once the decoded pixel data
+    exceeds max_bytes. Each entry holds the decoded image and
+    the digest of the bytes it was decoded from.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(image):
+        width, height = image.size
+        return width * height * len(image.getbands())
+
+    def get(self, bytes_key, version, variant=None):
+        # returns (image, digest) or (None, None)
+        with self.lock:
+            try:
+                entry = self.entries[(bytes_key, version, variant)]
+            except KeyError:
+                self.misses += 1
+                return None, None
+            self.entries.move_to_end((bytes_key, version, variant))
+            self.hits += 1
+            return entry
+
+    def put(self, bytes_key, version, image, digest=None, variant=None):
+        size = self.image_bytes(image)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            # drop decodes of older contents, other variants of
+            # the same contents are kept
+            self._remove(
+                bytes_key,
+                lambda entry_key: entry_key[1] < version
+                or entry_key[1:] == (version, variant),
+            )
+            self.entries[(bytes_key, version, variant)] = (image, digest)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.current_bytes -= self.image_bytes(evicted)
+        return True
+
+    def invalidate(self, bytes_key):
+        with self.lock:
+            self._remove(bytes_key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, bytes_key, matches=lambda entry_key: True):
+        for entry_key in [k for k in self.entries if k[0] == bytes_key and matches(k)]:
+            self.current_bytes -= self.image_bytes(self.entries.pop(entry_key)[0])
+
+
+image_cache = ImageCache()
+
+
+def blob_version(redis_conn, bytes_key):
+    version = redis_conn.hget(BINARY_VERSIONS_KEY, bytes_key)
+    if version is None:
+        version = 0
+    return int(version)
+
+
+def blob_written(redis_conn, bytes_key):
+    # bump version and drop any cached decode of bytes_key
+    redis_conn.hincrby(BINARY_VERSIONS_KEY, bytes_key, 1)
+    image_cache.invalidate(bytes_key)
+
+
+def exif_orientation_field(key):
+    # hash field set while the image in key has a pending
+    # exif orientation that has not been applied to its pixels
+    return "{}_exif_orientation".format(key)
+
+
+# access modes for open_image and open_bytes
+READ = "r"
+READ_WRITE = "rw"
+
+
+class ImageHandle(object):
+    """Decoded image yielded by open_image
+
+    Operations that produce a new image, such as rotate or
+    crop, assign it to handle.image. Operations that change
+    pixels in place get the image from handle.writable() or
+    handle.draw(). Either marks the handle dirty and only
+    dirty handles are encoded and written back on exit.
+
+    digest identifies the stored bytes the image was decoded
+    from and is None once the image has been changed.
+    """
+
+    def __init__(
+        self, image, bytes_key=None, mode=READ_WRITE, shared=False, digest=None
+    ):
+        self._image = image
+        self._digest = digest
+        self.format = image.format
+        self.bytes_key = bytes_key
+        self.mode = mode
+        # shared images are owned by image_cache and are
+        # copied before being changed in place
+        self.shared = shared
+        self.dirty = False
+
+    @property
+    def image(self):
+        return self._image
+
+    @property
+    def digest(self):
+        if self.dirty:
+            return None
+        return self._digest
+
+    @image.setter
+    def image(self, image):
+        self._check_writable()
+        self._image = image
+        self.shared = False
+        self.dirty = True
+
+    def writable(self):
+        self._check_writable()
+        if self.shared:
+            self._image = self._image.copy()
+            self.shared = False
+        self.dirty = True
+        return self._image
+
+    def draw(self):
+        return ImageDraw.Draw(self.writable())
+
+    def _check_writable(self):
+        if self.mode != READ_WRITE:
+            raise ValueError("{} opened read only".format(self.bytes_key))
 
 
 @contextmanager
-def open_image(uuid, key, redis_conn, binary_r):
-    key_bytes = None
-    bytes_key = redis_conn.hget(uuid, key)
-    key_bytes = binary_r.get(bytes_key)
-    file = io.BytesIO()
-    file.write(key_bytes)
-    image = Image.open(file)
-    yield image
-    file = io.BytesIO()
-    image.save(file, image.format)
-    image.close()
-    file.seek(0)
-    binary_r.set(bytes_key, file.read())
-    file.close()
+def open_image(uuid, key, redis_conn, binary_r, mode=READ_WRITE, max_size=None):
+    """Open the image stored in key of hash uuid
+
+        Args:
+            mode(str): READ or READ_WRITE, only dirty READ_WRITE
+                handles are written back
+            max_size(int): decode at a reduced resolution that
+                fits within max_size, only allowed with READ
+    """
+    if max_size is not None and mode != READ:
+        raise ValueError("reduced images can only be opened read only")
+    bytes_key, orientation, preview_key = redis_conn.hmget(
+        uuid, [key, exif_orientation_field(key), preview_field(key)]
+    )
+    version = blob_version(redis_conn, bytes_key)
+    image, digest = image_cache.get(bytes_key, version, variant=max_size)
+    shared = image is not None
+    if image is None:
+        image_bytes = read_blob(binary_r, bytes_key)
+        digest = hashlib.sha1(image_bytes).hexdigest()
+        image = Image.open(io.BytesIO(image_bytes))
+        if max_size is not None:
+            image = reduced_image(image, int(max_size))
+        image.load()
+        if orientation not in (None, "1"):
+            # apply a rotation made by img_rotate with "exif"
+            # now that the pixels are needed
+            image_format = image.format
+            image = ImageOps.exif_transpose(image)
+            image.format = image_format
+        shared = image_cache.put(bytes_key, version, image, digest, variant=max_size)
+    handle = ImageHandle(image, bytes_key, mode=mode, shared=shared, digest=digest)
+    yield handle
+    if handle.dirty:
+        file = io.BytesIO()
+        handle.image.save(file, handle.format)
+        handle.image.close()
+        with file.getbuffer() as view:
+            rewrite_blob(uuid, key, bytes_key, view, redis_conn, binary_r)
+        file.close()
+        # a stored preview no longer matches the image and
+        # pending orientation was applied by the save
+        redis_conn.hdel(uuid, preview_field(key), exif_orientation_field(key))
+        if preview_key:
+            blob_unref(redis_conn, preview_key)
 
 
 @contextmanager
-def open_bytes(uuid, key, redis_conn, binary_r):
-    key_bytes = None
+def open_bytes(uuid, key, redis_conn, binary_r, mode=READ_WRITE):
     bytes_key = redis_conn.hget(uuid, key)
-    key_bytes = binary_r.get(bytes_key)
-    file = io.BytesIO()
-    file.write(key_bytes)
+    key_bytes = read_blob(binary_r, bytes_key)
+    file = io.BytesIO(key_bytes)
     yield file
-    file.seek(0)
-    binary_r.set(bytes_key, file.read())
+    with file.getbuffer() as view:
+        # only write back if the contents were changed
+        if mode == READ_WRITE and view != key_bytes:
+            rewrite_blob(uuid, key, bytes_key, view, redis_conn, binary_r)
     file.close()
 
 
 def write_bytes(
-    hash_uuid, key, write_bytes, key_prefix="", redis_conn=None, binary_r=None
+    hash_uuid,
+    key,
+    write_bytes,
+    key_prefix="",
+    redis_conn=None,
+    binary_r=None,
+    previous=None,
+    content_addressed_key=None,
 ):
-    bytes_key_uuid = str(uuid.uuid4())
-    bytes_key = "{}{}".format(key_prefix, bytes_key_uuid)
-    binary_r.set(bytes_key, write_bytes)
+    # previous is the blob key the field referenced before
+    # this write, "" for none. It is read from redis_conn when
+    # None, so callers using a pipeline must pass it.
+    if previous is None:
+        previous = redis_conn.hget(hash_uuid, key)
+    bytes_key = store_blob(
+        binary_r,
+        redis_conn,
+        write_bytes,
+        key_prefix=key_prefix,
+        content_addressed_key=content_addressed_key,
+    )
+    blob_written(redis_conn, bytes_key)
     redis_conn.hset(hash_uuid, key, bytes_key)
+    if previous:
+        blob_unref(redis_conn, previous)
+    return bytes_key
+
+
+def rewrite_blob(uuid, key, bytes_key, data, redis_conn, binary_r):
+    # replace the contents of the blob in key of hash uuid.
+    # Content addressed blobs may be shared with other fields
+    # so a new blob is stored and the field repointed instead.
+    if is_content_key(bytes_key):
+        return write_bytes(
+            uuid,
+            key,
+            data,
+            key_prefix=bytes_key[: bytes_key.index(CONTENT_PREFIX)],
+            redis_conn=redis_conn,
+            binary_r=binary_r,
+            previous=bytes_key,
+            content_addressed_key=True,
+        )
+    write_blob(binary_r, bytes_key, data)
+    blob_written(redis_conn, bytes_key)
+    return bytes_key
+
+
+def ocr_regions(handle, redis_conn, rectangles, psm=PSM.AUTO, lang="eng"):
+    """OCR rectangles of an opened image
+
+        Results are looked up in the ocr cache first and
+        recognition runs once per missing rectangle using a
+        pooled engine.
+
+        Args:
+            handle(ImageHandle): image to ocr
+            redis_conn: connection for the ocr cache
+            rectangles(list): (left, top, width, height) tuples
+                or None for the whole image
+
+        Returns:
+            list: text for each rectangle
+    """
+    cache = OcrCache(redis_conn)
+    params = [
+        {"psm": psm, "lang": lang, "rectangle": rectangle, "size": handle.image.size}
+        for rectangle in rectangles
+    ]
+    digest = handle.digest
+    if digest is not None:
+        results = cache.lookup_many(digest, params)
+    else:
+        results = [None] * len(rectangles)
+
+    if None in results:
+        with tesseract_pool.borrow(lang=lang, psm=psm) as api:
+            api.SetImage(handle.image)
+            for i, rectangle in enumerate(rectangles):
+                if results[i] is not None:
+                    continue
+                start = time.perf_counter()
+                if rectangle is not None:
+                    api.SetRectangle(*rectangle)
+                results[i] = api.GetUTF8Text()
+                if digest is not None:
+                    cache.store(
+                        digest, params[i], results[i], time.perf_counter() - start
+                    )
+    return results
+
+
+def region_psm(region):
+    # page segmentation mode of an img_ocr_regions region
+    psm = region.get("psm")
+    if psm is None:
+        return PSM.SINGLE_BLOCK if region.get("fan_in") else PSM.AUTO
+    if isinstance(psm, str) and not psm.isdigit():
+        return getattr(PSM, psm.upper())
+    return int(psm)
+
+
+def ocr_text(handle, redis_conn, psm=PSM.SINGLE_BLOCK, lang="eng"):
+    # set PSM (Page Segmentation Mode) to 6 (SINGLE_BLOCK)
+    # to handle images containing only numerals
+    return ocr_regions(handle, redis_conn, [None], psm=psm, lang=lang)[0].strip()
+
+
+DEFAULT_FONT = "FreeSerif.ttf"
+# searched in order for fonts given without a directory
+FONT_DIRS = ["/usr/share/fonts/truetype/freefont", "/usr/share/fonts/gnu-free"]
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_font_path(font_path):
+    if not os.path.isabs(font_path):
+        for font_dir in FONT_DIRS:
+            candidate = os.path.join(font_dir, font_path)
+            if os.path.isfile(candidate):
+                return candidate
+    # let PIL search its own font locations
+    return font_path
+
+
+@functools.lru_cache(maxsize=32)
+def get_font(font_path, size):
+    return ImageFont.truetype(resolve_font_path(font_path), size)
+
+
+# characters used by grid labels
+GRID_GLYPHS = "0123456789(), -"
+
+
+def text_size(font, text):
+    try:
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    except AttributeError:
+        return font.getsize(text)
+
+
+@functools.lru_cache(maxsize=1)
+def glyph_atlas():
+    """Render GRID_GLYPHS once with the default font
+
+    Returns a sprite atlas image and a dict of character to
+    its box in the atlas.
+    """
+    font = ImageFont.load_default()
+    sizes = [text_size(font, glyph) for glyph in GRID_GLYPHS]
+    atlas = Image.new("L", (sum(w for w, _ in sizes), max(h for _, h in sizes)), 0)
+    draw = ImageDraw.Draw(atlas)
+    boxes = {}
+    x = 0
+    for glyph, (w, h) in zip(GRID_GLYPHS, sizes):
+        draw.text((x, 0), glyph, fill=255, font=font)
+        boxes[glyph] = (x, 0, x + w, atlas.height)
+        x += w
+    return atlas, boxes
+
+
+@functools.lru_cache(maxsize=len(GRID_GLYPHS))
+def glyph_mask(glyph):
+    atlas, boxes = glyph_atlas()
+    return atlas.crop(boxes[glyph])
+
+
+def stamp_text(image, position, text, fill):
+    # paste pre-rendered glyph masks instead of rendering text
+    x, y = position
+    for glyph in text:
+        mask = glyph_mask(glyph)
+        image.paste(fill, (x, y, x + mask.width, y + mask.height), mask)
+        x += mask.width
+
+
+def stamp_text_size(text):
+    return (
+        sum(glyph_mask(glyph).width for glyph in text),
+        glyph_atlas()[0].height,
+    )
+
+
+# overlays are as large as the image, so they are bounded by
+# bytes like decoded images rather than by a count of entries
+grid_cache = ImageCache(max_bytes=128 * 1024 * 1024)
+
+
+def grid_overlay(size, xspacing, yspacing, rgba, label):
+    """Grid lines and labels as a transparent RGBA layer
+
+    Cached by arguments so that repeated grids over images of
+    the same size are composited without redrawing.
+    """
+    key = (size, xspacing, yspacing, rgba, label)
+    overlay, _ = grid_cache.get(key, 0)
+    if overlay is None:
+        overlay = _draw_grid_overlay(size, xspacing, yspacing, rgba, label)
+        grid_cache.put(key, 0, overlay)
+    return overlay
+
+
+def _draw_grid_overlay(size, xspacing, yspacing, rgba, label):
+    imgw, imgh = size
+    overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    text_fill = (255, 255, 255, rgba[3])
+
+    for col in range(0, imgw, xspacing):
+        draw.line((col, 0, col, imgh), fill=rgba)
+
+    for row in range(0, imgh, yspacing):
+        draw.line((0, row, imgw, row), fill=rgba)
+
+    if label:
+        grid_number = 0
+        for col in range(0, imgw, xspacing):
+            for row in range(0, imgh, yspacing):
+                stamp_text(overlay, (col, row), "({}, {})".format(col, row), text_fill)
+                grid_label = str(grid_number)
+                w, h = stamp_text_size(grid_label)
+                tx = int(round(col + (xspacing / 2) - (w / 2)))
+                ty = int(round(row + (yspacing / 2) - (h / 2)))
+                stamp_text(overlay, (tx, ty), grid_label, text_fill)
+                grid_number += 1
+    return overlay
+
+
+# connections used by bulk ocr worker processes
+_bulk_conns = {}
+
+
+def _bulk_ocr_init(db_host, db_port):
+    _bulk_conns["binary_r"] = redis.StrictRedis(host=db_host, port=db_port)
+    _bulk_conns["redis_conn"] = redis.StrictRedis(
+        host=db_host, port=db_port, decode_responses=True
+    )
+    # pages are only read once, do not hold decodes in memory
+    image_cache.max_bytes = 0
+
+
+def _bulk_ocr(job):
+    glworb, key = job
+    try:
+        with open_image(
+            glworb,
+            key,
+            _bulk_conns["redis_conn"],
+            _bulk_conns["binary_r"],
+            mode=READ,
+        ) as handle:
+            return glworb, ocr_text(handle, _bulk_conns["redis_conn"]), None
+    except Exception as ex:
+        return glworb, None, str(ex)
 
 
 class keli_img(object):
@@ -62,10 +529,161 @@ class keli_img(object):
         else:
             r_ip, r_port = db_host, db_port
 
+        self.db_host = r_ip
+        self.db_port = r_port
         self.binary_r = redis.StrictRedis(host=r_ip, port=r_port)
         self.redis_conn = redis.StrictRedis(
             host=r_ip, port=r_port, decode_responses=True
         )
+        # images held open by run_steps, keyed by (uuid, key),
+        # per thread so that keli serve can run pipelines of
+        # different commands concurrently
+        self._held = threading.local()
+
+    @property
+    def held_images(self):
+        try:
+            return self._held.images
+        except AttributeError:
+            self._held.images = {}
+            return self._held.images
+
+    @contextmanager
+    def _open(self, uuid, key, mode=READ_WRITE):
+        # use the in-memory image when a pipeline is
+        # running on uuid, key instead of fetching it
+        held = self.held_images.get((uuid, key))
+        if held is not None:
+            yield held
+        else:
+            with open_image(
+                uuid, key, self.redis_conn, self.binary_r, mode=mode
+            ) as handle:
+                yield handle
+
+    @contextmanager
+    def _open_reduced(self, uuid, key, max_size=PREVIEW_SIZE):
+        # read only access for operations that do not need full
+        # resolution: use the pipeline image if one is held,
+        # otherwise a stored preview or a reduced decode of key
+        if (uuid, key) in self.held_images:
+            with self._open(uuid, key, mode=READ) as handle:
+                yield handle
+            return
+        if self.redis_conn.hexists(uuid, preview_field(key)):
+            key = preview_field(key)
+        with open_image(
+            uuid, key, self.redis_conn, self.binary_r, mode=READ, max_size=max_size
+        ) as handle:
+            yield handle
+
+    def run_steps(self, context, steps):
+        """Run several img_* operations on a single decode
+
+            The image for context is fetched and decoded once,
+            each step is applied to the in-memory image and the
+            result is encoded and written back once at the end.
+
+            Args:
+                context(dict): dictionary of context info
+                steps(list): sequence of (name, *args) lists or
+                    dicts with "name", "args" and "kwargs"
+
+            Returns:
+                dict: context with step_timings as a list of
+                (name, seconds)
+        """
+        timings = []
+        hold = (context["uuid"], context["key"])
+        with self._open(*hold) as handle:
+            self.held_images[hold] = handle
+            try:
+                for step in steps:
+                    if isinstance(step, dict):
+                        name = step["name"]
+                        step_args = step.get("args", [])
+                        step_kwargs = step.get("kwargs", {})
+                    else:
+                        name, step_args, step_kwargs = step[0], step[1:], {}
+                    name = name.replace("-", "_")
+                    if not name.startswith("img_") or name == "img_pipeline":
+                        raise ValueError("not a pipeline step: {}".format(name))
+                    start = time.perf_counter()
+                    getattr(self, name)(context, *step_args, **step_kwargs)
+                    timings.append((name, time.perf_counter() - start))
+                    logger.info("{} {:.4f}s".format(name, timings[-1][1]))
+            finally:
+                del self.held_images[hold]
+            start = time.perf_counter()
+        timings.append(("write", time.perf_counter() - start))
+        logger.info("write {:.4f}s".format(timings[-1][1]))
+        context["step_timings"] = timings
+        return context
+
+    def img_pipeline(self, context, steps, *args):
+        """Run steps on a single decode, see run_steps
+
+            Args:
+                context(dict): dictionary of context info
+                steps(str): json list of steps or semicolon
+                    separated steps such as
+                    "img-rotate 90; img-ocr page_text".
+                    name=value arguments are passed as kwargs
+                *args:
+
+            Returns:
+                dict
+        """
+        if isinstance(steps, str):
+            if steps.lstrip().startswith("["):
+                steps = json.loads(steps)
+            else:
+                parsed = []
+                for step in steps.split(";"):
+                    tokens = shlex.split(step)
+                    if not tokens:
+                        continue
+                    parsed.append(
+                        {
+                            "name": tokens[0],
+                            "args": [t for t in tokens[1:] if "=" not in t],
+                            "kwargs": dict(
+                                t.split("=", 1) for t in tokens[1:] if "=" in t
+                            ),
+                        }
+                    )
+                steps = parsed
+        return self.run_steps(context, steps)
+
+    def img_cache_stats(self, context, *args):
+        """Decoded image cache statistics
+
+            Args:
+                context(dict): dictionary of context info
+                *args:
+
+            Returns:
+                dict
+        """
+        stats = image_cache.stats()
+        logger.info("image cache: {}".format(stats))
+        context["image_cache"] = stats
+        return context
+
+    def img_ocr_cache_stats(self, context, *args):
+        """OCR result cache hit rate and time saved
+
+            Args:
+                context(dict): dictionary of context info
+                *args:
+
+            Returns:
+                dict
+        """
+        stats = OcrCache(self.redis_conn).stats()
+        logger.info("ocr cache: {}".format(stats))
+        context["ocr_cache"] = stats
+        return context
 
     # @route_broadcast(channel='{function}',message='context')
     def img_show(self, context, *args):
@@ -73,15 +691,18 @@ class keli_img(object):
 
             Args:
                 context(dict): dictionary of context info
-                *args:
+                *args: "full" to show the full resolution image
+                    instead of a preview
 
             Returns:
                 dict
         """
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            img.show()
+        if "full" in args:
+            opened = self._open(context["uuid"], context["key"], mode=READ)
+        else:
+            opened = self._open_reduced(context["uuid"], context["key"])
+        with opened as handle:
+            handle.image.show()
         return context
 
     def img_overlay(self, context, text, x, y, fontsize, *args):
@@ -97,53 +718,102 @@ class keli_img(object):
             Returns:
                 dict
         """
-        text = str(text)
+        return self.img_overlay_many(
+            context, [{"text": text, "x": x, "y": y, "fontsize": fontsize}]
+        )
 
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            draw = ImageDraw.Draw(img)
-            try:
-                font = ImageFont.truetype("FreeSerif.ttf", fontsize)
-                draw.text((x, y), text, (255, 255, 255), font=font)
-            except Exception as ex:
-                font = ImageFont.truetype(
-                    "/usr/share/fonts/truetype/freefont/FreeSerif.ttf", fontsize
+    def img_overlay_many(self, context, items, *args):
+        """Overlay several text items in one decode
+
+            Args:
+                context(dict): dictionary of context info
+                items: json string or list of dicts with text,
+                    x and y and optionally fontsize, color as an
+                    [r, g, b] list or color name and font path
+                *args:
+
+            Returns:
+                dict
+        """
+        if isinstance(items, str):
+            items = json.loads(items)
+
+        with self._open(context["uuid"], context["key"]) as handle:
+            draw = handle.draw()
+            for item in items:
+                font = get_font(
+                    item.get("font", DEFAULT_FONT), int(item.get("fontsize", 24))
+                )
+                color = item.get("color", (255, 255, 255))
+                if isinstance(color, list):
+                    color = tuple(color)
+                draw.text(
+                    (int(item["x"]), int(item["y"])),
+                    str(item["text"]),
+                    color,
+                    font=font,
                 )
-                draw.text((x, y), text, (255, 255, 255), font=font)
 
         return context
 
-    def img_rotate(self, context, rotation, *args):
+    def img_rotate(self, context, rotation, exif=False, *args):
         """Rotate in place
 
             Args:
                 context(dict): dictionary of context info
                 rotation(float): degrees of rotation
+                exif: only rewrite the jpeg exif orientation,
+                    the pixels are rotated when next opened.
+                    The pixels are rotated instead for angles
+                    that are not multiples of 90 degrees, for
+                    images that are not jpeg and for images
+                    held by img-pipeline, whose pixels are
+                    written when the pipeline ends
                 *args:
 
             Returns:
                 dict
         """
+        rotation = float(rotation)
+        if (
+            exif
+            and exif != "False"
+            and (context["uuid"], context["key"]) not in self.held_images
+            and self._rotate_exif(context["uuid"], context["key"], rotation)
+        ):
+            return context
 
-        # use open_bytes instead of open_image
-        # because yielded image does not seem
-        # to be mutated despite img = img.rotate
-
-        with open_bytes(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            image = Image.open(img)
-            ext = image.format
-            image = image.rotate(float(rotation), expand=True)
-            img.seek(0)
-            image.save(img, ext)
-
-        # with open_image(context['uuid'],context['key']) as img:
-        #     img = img.rotate(float(rotation),expand=True)
+        with self._open(context["uuid"], context["key"]) as handle:
+            if rotation % 360:
+                handle.image = handle.image.rotate(rotation, expand=True)
 
         return context
 
+    def _rotate_exif(self, uuid, key, rotation):
+        # rotate by rewriting the exif orientation tag, returns
+        # False if the rotation or format does not allow it.
+        #
+        # open_image ignores a tag written by the camera until
+        # the orientation field is set, so the rotation builds on
+        # the field and overwrites the camera tag
+        bytes_key, current = self.redis_conn.hmget(
+            uuid, [key, exif_orientation_field(key)]
+        )
+        orientation = jpeg_exif.rotated_orientation(int(current or 1), rotation)
+        if orientation is None:
+            return False
+        data = read_blob(self.binary_r, bytes_key)
+        patched = jpeg_exif.set_orientation(data, orientation)
+        if patched is None:
+            return False
+        rewrite_blob(uuid, key, bytes_key, patched, self.redis_conn, self.binary_r)
+        self.redis_conn.hset(uuid, exif_orientation_field(key), orientation)
+        preview_key = self.redis_conn.hget(uuid, preview_field(key))
+        if preview_key:
+            self.redis_conn.hdel(uuid, preview_field(key))
+            blob_unref(self.redis_conn, preview_key)
+        return True
+
     def img_grid(
         self,
         context,
@@ -181,33 +851,18 @@ class keli_img(object):
         b = int(b)
         a = int(a)
 
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            draw = ImageDraw.Draw(img)
-            imgw, imgh = img.size
-
-            for col in range(0, imgw, xspacing):
-                draw.line((col, 0, col, imgh), fill=(r, g, b))
+        if label in ("False", "false", "0", ""):
+            label = False
 
-            for row in range(0, imgh, yspacing):
-                draw.line((0, row, imgw, row), fill=(r, g, b))
-
-            if label:
-                grid_number = 0
-                for col in range(0, imgw, xspacing):
-                    for row in range(0, imgh, yspacing):
-                        draw.text(
-                            (col, row),
-                            str("({}, {})".format(col, row)),
-                            (255, 255, 255),
-                        )
-                        grid_label = str("{}".format(grid_number))
-                        w, h = draw.textsize(grid_label)
-                        tx = int(round(col + (xspacing / 2) - (w / 2)))
-                        ty = int(round(row + (yspacing / 2) - (h / 2)))
-                        draw.text((tx, ty), grid_label, (255, 255, 255))
-                        grid_number += 1
+        with self._open(context["uuid"], context["key"]) as handle:
+            overlay = grid_overlay(
+                handle.image.size, xspacing, yspacing, (r, g, b, a), bool(label)
+            )
+            img = handle.writable()
+            if img.mode == "RGBA":
+                img.alpha_composite(overlay)
+            else:
+                img.paste(overlay, (0, 0), overlay)
         return context
 
     def img_crop_inplace(self, context, x1, y1, width, height, *args):
@@ -230,9 +885,8 @@ class keli_img(object):
         width = float(width)
         height = float(height)
 
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
+        with self._open(context["uuid"], context["key"]) as handle:
+            img = handle.image
             if "scale" in args:
                 width_size, height_size = img.size
                 x1 *= width_size
@@ -240,7 +894,8 @@ class keli_img(object):
                 width *= width_size
                 height *= height_size
             box = (x1, y1, x1 + width, y1 + height)
-            img = img.crop(box)
+            if box != (0, 0) + img.size:
+                handle.image = img.crop(box)
 
         return context
 
@@ -259,54 +914,104 @@ class keli_img(object):
             Returns:
                 dict:
         """
+        return self.img_crop_many(
+            context, [{"box": [x1, y1, width, height], "to_key": to_key}], *args
+        )
+
+    def img_crop_many(self, context, crops, *args):
+        """Crop several selections from context to new keys
+
+            The source is decoded once, crops are encoded in
+            parallel threads and all blobs and keys are written
+            in one pipeline.
+
+            Args:
+                context(dict): dictionary of context info
+                crops: json string or list of dicts with box as
+                    [x1, y1, width, height], to_key and optionally
+                    format and quality
+                *args: "scale" to treat coordinates as fractions
+                    of the image size
+
+            Returns:
+                dict:
+        """
         if "binary_prefix" not in context:
             context["binary_prefix"] = "binary:"
 
-        x1 = float(x1)
-        y1 = float(y1)
-        width = float(width)
-        height = float(height)
+        if isinstance(crops, str):
+            crops = json.loads(crops)
 
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            if "scale" in args:
-                width_size, height_size = img.size
-                x1 *= width_size
-                y1 *= height_size
-                width *= width_size
-                height *= height_size
-            box = (x1, y1, x1 + width, y1 + height)
-            region = img.crop(box)
-            filelike = io.BytesIO()
-            region.save(filelike, img.format)
-            filelike.seek(0)
-            write_bytes(
+        with self._open(context["uuid"], context["key"], mode=READ) as handle:
+            img = handle.image
+            regions = []
+            for crop in crops:
+                x1, y1, width, height = [float(v) for v in crop["box"]]
+                if "scale" in args:
+                    width_size, height_size = img.size
+                    x1 *= width_size
+                    y1 *= height_size
+                    width *= width_size
+                    height *= height_size
+                box = (x1, y1, x1 + width, y1 + height)
+                regions.append((img.crop(box), crop))
+
+            def encode(region_crop):
+                region, crop = region_crop
+                filelike = io.BytesIO()
+                save_args = {}
+                if "quality" in crop:
+                    save_args["quality"] = int(crop["quality"])
+                region.save(filelike, crop.get("format", handle.format), **save_args)
+                return filelike.getvalue()
+
+            with ThreadPoolExecutor(
+                max_workers=min(len(regions), os.cpu_count() or 1) or 1
+            ) as pool:
+                encoded = list(pool.map(encode, regions))
+
+        # blob each field references, updated as crops are written
+        # so that a later crop to the same key replaces the earlier
+        to_keys = [crop["to_key"] for _, crop in regions]
+        previous = dict(zip(to_keys, self.redis_conn.hmget(context["uuid"], to_keys)))
+        pipe = self.binary_r.pipeline()
+        # deduplicating references and checks existing blobs
+        # immediately, so binary_r cannot be the pipeline
+        binary_r = self.binary_r if content_addressed() else pipe
+        for (_, crop), crop_bytes in zip(regions, encoded):
+            previous[crop["to_key"]] = write_bytes(
                 context["uuid"],
-                to_key,
-                filelike.read(),
+                crop["to_key"],
+                crop_bytes,
                 key_prefix=context["binary_prefix"],
-                redis_conn=self.redis_conn,
-                binary_r=self.binary_r,
+                redis_conn=pipe,
+                binary_r=binary_r,
+                previous=previous[crop["to_key"]] or "",
             )
-            filelike.close()
+        pipe.execute()
 
         return context
 
-    def img_orientation(self, context, *args):
+    def img_orientation(self, context, to_key="orientation", *args):
         """Calculate text orientation using tesseract
 
+            Uses a stored preview or a reduced resolution
+            decode since orientation detection does not need
+            every pixel.
+
             Args:
                 context(dict): dictionary of context info
+                to_key(str): key to store orientation, writing
+                    direction, textline order and deskew angle
+                    are stored in to_key_* keys
                 *args:
 
             Returns:
                 dict
         """
-        with PyTessBaseAPI(psm=PSM.AUTO_OSD) as api:
-            with open_image(
-                context["uuid"], context["key"], self.redis_conn, self.binary_r
-            ) as img:
+        with tesseract_pool.borrow(psm=PSM.AUTO_OSD) as api:
+            with self._open_reduced(context["uuid"], context["key"]) as handle:
+                img = handle.image
                 api.SetImage(img)
                 api.Recognize()
                 it = api.AnalyseLayout()
@@ -316,6 +1021,16 @@ class keli_img(object):
                 logger.info("TextlineOrder: {:d}".format(order))
                 logger.info("Deskew angle: {:.4f}".format(deskew_angle))
 
+        self.redis_conn.hmset(
+            context["uuid"],
+            {
+                to_key: orientation,
+                "{}_writing_direction".format(to_key): direction,
+                "{}_textline_order".format(to_key): order,
+                "{}_deskew_angle".format(to_key): deskew_angle,
+            },
+        )
+
         # LSTM_ONLY needs 4.0
         # https://github.com/tesseract-ocr/tesseract/wiki/4.0-with-LSTM
         return context
@@ -324,13 +1039,9 @@ class keli_img(object):
         # For multiple ocr regions written to a single key
         # write: if ocr result is empty and to_key does not exist
         # do not write: if ocr result is empty and key exists
-        psm = 6
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            logger.info(image_to_text(img, psm=psm))
-            # r redis conn basically global
-            ocr_result = image_to_text(img, psm=psm).strip()
+        with self._open(context["uuid"], context["key"], mode=READ) as handle:
+            ocr_result = ocr_text(handle, self.redis_conn)
+            logger.info(ocr_result)
             print(self.redis_conn.hget(context["uuid"], to_key))
             if (
                 not ocr_result
@@ -356,15 +1067,83 @@ class keli_img(object):
         """
         # set PSM (Page Segmentation Mode) to 6 to handle
         # images containing only numerals
-        psm = 6
-        with open_image(
-            context["uuid"], context["key"], self.redis_conn, self.binary_r
-        ) as img:
-            logger.info(image_to_text(img, psm=psm))
-            # r redis conn basically global
-            self.redis_conn.hset(
-                context["uuid"], to_key, image_to_text(img, psm=psm).strip()
+        with self._open(context["uuid"], context["key"], mode=READ) as handle:
+            ocr_result = ocr_text(handle, self.redis_conn)
+        logger.info(ocr_result)
+        self.redis_conn.hset(context["uuid"], to_key, ocr_result)
+        return context
+
+    def img_ocr_bulk(
+        self,
+        context,
+        to_key,
+        structured_sequence=None,
+        workers=None,
+        resume=True,
+        batch=50,
+        *args
+    ):
+        """OCR many glworbs using a pool of worker processes
+
+            Args:
+                context(dict): dictionary of context info,
+                    context["uuid"] is a scan pattern such as
+                    glworb:* and context["key"] the image field
+                to_key(str): key to store ocr results
+                structured_sequence(str): list of glworbs to use
+                    instead of the scan pattern
+                workers(int): worker processes, defaults to cpu count
+                resume(bool): skip glworbs that already have to_key
+                batch(int): results per pipelined write
+                *args:
+
+            Returns:
+                dict
+        """
+        if structured_sequence is not None:
+            glworbs = self.redis_conn.lrange(structured_sequence, 0, -1)
+        else:
+            glworbs = list(self.redis_conn.scan_iter(match=context["uuid"]))
+
+        if resume and resume != "False":
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for glworb in glworbs:
+                pipe.hexists(glworb, to_key)
+            done = pipe.execute()
+            glworbs = [g for g, exists in zip(glworbs, done) if not exists]
+
+        jobs = [(glworb, context["key"]) for glworb in glworbs]
+        workers = int(workers or os.cpu_count() or 1)
+        start = time.perf_counter()
+        processed = 0
+        errors = 0
+        pipe = self.redis_conn.pipeline(transaction=False)
+        # spawn rather than fork, forking a threaded process such
+        # as keli serve can copy locks held by other threads
+        with multiprocessing.get_context("spawn").Pool(
+            workers, _bulk_ocr_init, (self.db_host, self.db_port)
+        ) as pool:
+            for glworb, ocr_result, error in pool.imap_unordered(_bulk_ocr, jobs):
+                if error is not None:
+                    logger.error("{}: {}".format(glworb, error))
+                    errors += 1
+                    continue
+                pipe.hset(glworb, to_key, ocr_result)
+                processed += 1
+                if processed % int(batch) == 0:
+                    pipe.execute()
+        pipe.execute()
+
+        elapsed = time.perf_counter() - start
+        pages_per_second = processed / elapsed if elapsed else 0
+        logger.info(
+            "ocr {} pages, {} errors, {:.2f} pages/sec".format(
+                processed, errors, pages_per_second
             )
+        )
+        context["ocr_pages"] = processed
+        context["ocr_errors"] = errors
+        context["pages_per_second"] = pages_per_second
         return context
 
     def img_ocr_key(self, context, key, to_key, *args):
@@ -381,47 +1160,138 @@ class keli_img(object):
         """
         # set PSM (Page Segmentation Mode) to 6 to handle
         # images containing only numerals
-        psm = 6
-        with open_image(context["uuid"], key, self.redis_conn, self.binary_r) as img:
-            logger.info(image_to_text(img, psm=psm))
-            # r redis conn basically global
-            # set PSM (Page Segmentation Mode) to 6 to handle
-            # images containing only numerals
-            self.redis_conn.hset(
-                context["uuid"], to_key, image_to_text(img, psm=psm).strip()
-            )
+        with self._open(context["uuid"], key, mode=READ) as handle:
+            ocr_result = ocr_text(handle, self.redis_conn)
+        logger.info(ocr_result)
+        self.redis_conn.hset(context["uuid"], to_key, ocr_result)
         return context
 
     def img_ocr_rectangle(self, context, to_key, left, top, width, height, *args):
-        with PyTessBaseAPI() as api:
-            with open_image(
-                context["uuid"], context["key"], self.redis_conn, self.binary_r
-            ) as img:
-                api.SetImage(img)
-                api.SetRectangle(left, top, width, height)
-                result = api.GetUTF8Text()
-                logger.info(result)
-                self.redis_conn.hset(context["uuid"], to_key, result)
-                logger.info(
-                    "setting {} field {} to {}".format(context["uuid"], to_key, result)
+        with self._open(context["uuid"], context["key"], mode=READ) as handle:
+            (result,) = ocr_regions(
+                handle, self.redis_conn, [(left, top, width, height)]
+            )
+        logger.info(result)
+        self.redis_conn.hset(context["uuid"], to_key, result)
+        logger.info("setting {} field {} to {}".format(context["uuid"], to_key, result))
+        # store rectangle information in separate
+        # key to allow reconstruction of geometry
+        # of the ocr region
+        ocr_info_key = "region_ocr-rectangle_{key}".format(key=to_key)
+        ocr_geometry = ",".join([str(s) for s in [left, top, width, height]])
+        self.redis_conn.hset(context["uuid"], ocr_info_key, ocr_geometry)
+        logger.info(
+            "setting {} field {} to {}".format(
+                context["uuid"], ocr_info_key, ocr_geometry
+            )
+        )
+        return context
+
+    def img_ocr_regions(self, context, regions, *args):
+        """OCR several rectangles of an image in one pass
+
+            Args:
+                context(dict): dictionary of context info
+                regions: json string, dict or list of regions.
+                    a dict maps to_key to [left, top, width, height]
+                    or to a region dict. A region dict has to_key,
+                    box and optionally fan_in and write_empty,
+                    which behave as in img_ocr_fan_in, and psm, a
+                    page segmentation mode number or name. Fan in
+                    regions default to SINGLE_BLOCK and are
+                    stripped like img_ocr_fan_in, others use AUTO
+                *args: "scale" to treat coordinates as
+                    fractions of the image size like img_crop_inplace
+
+            Returns:
+                dict
+        """
+        if isinstance(regions, str):
+            regions = json.loads(regions)
+        if isinstance(regions, dict):
+            regions = [
+                (
+                    dict(region, to_key=to_key)
+                    if isinstance(region, dict)
+                    else {"to_key": to_key, "box": region}
                 )
-                # store rectangle information in separate
-                # key to allow reconstruction of geometry
-                # of the ocr region
-                ocr_info_key = "region_ocr-rectangle_{key}".format(key=to_key)
-                ocr_geometry = ",".join([str(s) for s in [left, top, width, height]])
-                self.redis_conn.hset(context["uuid"], ocr_info_key, ocr_geometry)
-                logger.info(
-                    "setting {} field {} to {}".format(
-                        context["uuid"], ocr_info_key, ocr_geometry
-                    )
+                for to_key, region in regions.items()
+            ]
+
+        fields = {}
+        with self._open(context["uuid"], context["key"], mode=READ) as handle:
+            width_size, height_size = handle.image.size
+            geometries = []
+            for region in regions:
+                left, top, width, height = [float(v) for v in region["box"]]
+                if "scale" in args:
+                    left *= width_size
+                    top *= height_size
+                    width *= width_size
+                    height *= height_size
+                geometries.append(
+                    tuple(int(round(v)) for v in (left, top, width, height))
                 )
+            # one pass for each page segmentation mode used
+            psms = [region_psm(region) for region in regions]
+            results = [None] * len(regions)
+            for psm in sorted(set(psms)):
+                indexes = [i for i, p in enumerate(psms) if p == psm]
+                for i, result in zip(
+                    indexes,
+                    ocr_regions(
+                        handle,
+                        self.redis_conn,
+                        [geometries[i] for i in indexes],
+                        psm=psm,
+                    ),
+                ):
+                    results[i] = result.strip() if regions[i].get("fan_in") else result
+
+        for region, geometry, result in zip(regions, geometries, results):
+            logger.info("{} {}".format(region["to_key"], result))
+            fields[region["to_key"]] = result
+            # geometry allows reconstruction of the
+            # ocr region, see img_ocr_rectangle
+            ocr_info_key = "region_ocr-rectangle_{key}".format(key=region["to_key"])
+            fields[ocr_info_key] = ",".join([str(s) for s in geometry])
+
+        # fan in: do not overwrite existing values with empty results
+        fan_in = [
+            region["to_key"]
+            for region in regions
+            if region.get("fan_in")
+            and not region.get("write_empty")
+            and not fields[region["to_key"]].strip()
+        ]
+        if fan_in:
+            existing = self.redis_conn.hmget(context["uuid"], fan_in)
+            for to_key, value in zip(fan_in, existing):
+                if value is not None:
+                    del fields[to_key]
+
+        if fields:
+            self.redis_conn.hmset(context["uuid"], fields)
+        return context
 
     def img_ocr_boxes(self, context, to_key, *args):
-        with PyTessBaseAPI() as api:
-            with open_image(
-                context["uuid"], context["key"], self.redis_conn, self.binary_r
-            ) as img:
+        """OCR text lines and store them as a packed box index
+
+            Args:
+                context(dict): dictionary of context info
+                to_key(str): key to store the box index, see
+                    img_ocr_boxes_query
+
+            Returns:
+                dict
+        """
+        if "binary_prefix" not in context:
+            context["binary_prefix"] = "binary:"
+
+        packed = []
+        with tesseract_pool.borrow() as api:
+            with self._open(context["uuid"], context["key"], mode=READ) as handle:
+                img = handle.image
                 api.SetImage(img)
                 boxes = api.GetComponentImages(RIL.TEXTLINE, True)
                 for i, (im, box, _, _) in enumerate(boxes):
@@ -433,4 +1303,56 @@ class keli_img(object):
                             i, conf, ocrResult, **box
                         )
                     )
+                    packed.append(
+                        (box["x"], box["y"], box["w"], box["h"], conf, ocrResult)
+                    )
+                size = img.size
+
+        write_bytes(
+            context["uuid"],
+            to_key,
+            pack_boxes(packed, size),
+            key_prefix=context["binary_prefix"],
+            redis_conn=self.redis_conn,
+            binary_r=self.binary_r,
+        )
+        return context
+
+    def img_ocr_boxes_query(
+        self, context, left, top, width, height, to_key=None, min_confidence=0, *args
+    ):
+        """Text intersecting a rectangle from a stored box index
+
+            Answers img_ocr_rectangle-style lookups from the
+            index written by img_ocr_boxes without tesseract.
+
+            Args:
+                context(dict): dictionary of context info,
+                    context["key"] is the key of the box index
+                left(float): rectangle x
+                top(float): rectangle y
+                width(float): rectangle width
+                height(float): rectangle height
+                to_key(str): optional key to store the text
+                min_confidence(float): ignore less confident boxes
+                *args: "scale" to treat coordinates as fractions
+                    of the image size
+
+            Returns:
+                dict: context with ocr_text
+        """
+        bytes_key = self.redis_conn.hget(context["uuid"], context["key"])
+        index = BoxIndex(read_blob(self.binary_r, bytes_key))
+        left, top, width, height = [float(v) for v in (left, top, width, height)]
+        if "scale" in args:
+            width_size, height_size = index.size
+            left *= width_size
+            top *= height_size
+            width *= width_size
+            height *= height_size
+        text = index.text_in(left, top, width, height, float(min_confidence))
+        logger.info(text)
+        if to_key is not None:
+            self.redis_conn.hset(context["uuid"], to_key, text)
+        context["ocr_text"] = text
         return context
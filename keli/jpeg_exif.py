@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import struct
+
+ORIENTATION_TAG = 0x0112
+
+# EXIF orientation to the counterclockwise rotation that
+# displays the image upright. Mirrored orientations
+# (2, 4, 5, 7) are not rotations and are not listed.
+ORIENTATION_DEGREES = {1: 0, 8: 90, 3: 180, 6: 270}
+DEGREES_ORIENTATION = {v: k for k, v in ORIENTATION_DEGREES.items()}
+
+
+def rotated_orientation(orientation, degrees):
+    """Orientation after a further counterclockwise rotation
+
+    Returns None if degrees is not a multiple of 90 or the
+    current orientation is mirrored.
+    """
+    if orientation not in ORIENTATION_DEGREES or float(degrees) % 90:
+        return None
+    return DEGREES_ORIENTATION[(ORIENTATION_DEGREES[orientation] + int(degrees)) % 360]
+
+
+def _segments(data):
+    # yield (marker, start, length) of jpeg segments before
+    # the image data, start is the offset of the 0xFF byte
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:
+            return
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        yield marker, pos, length
+        pos += 2 + length
+
+
+def _orientation_offset(data):
+    # offset of the orientation value in the exif segment or
+    # None, along with the tiff byte order
+    for marker, start, length in _segments(data):
+        payload = start + 4
+        if marker != 0xE1 or data[payload : payload + 6] != b"Exif\x00\x00":
+            continue
+        tiff = payload + 6
+        order = ">" if data[tiff : tiff + 2] == b"MM" else "<"
+        (ifd,) = struct.unpack(order + "I", data[tiff + 4 : tiff + 8])
+        (count,) = struct.unpack(order + "H", data[tiff + ifd : tiff + ifd + 2])
+        for i in range(count):
+            entry = tiff + ifd + 2 + i * 12
+            tag, kind = struct.unpack(order + "HH", data[entry : entry + 4])
+            if tag == ORIENTATION_TAG and kind == 3:
+                return entry + 8, order
+        return None, order
+    return None, None
+
+
+def is_jpeg(data):
+    return data[:2] == b"\xff\xd8"
+
+
+def get_orientation(data):
+    # orientation of jpeg bytes, 1 if no tag is present
+    if not is_jpeg(data):
+        return None
+    offset, order = _orientation_offset(data)
+    if offset is None:
+        return 1
+    return struct.unpack(order + "H", data[offset : offset + 2])[0]
+
+
+def set_orientation(data, orientation):
+    """Set the orientation tag of jpeg bytes without decoding
+
+    The tag is rewritten in place when present. A minimal
+    exif segment is inserted if the image has none. Returns
+    None if data is not a jpeg or has exif without an
+    orientation tag, which would need the exif rewritten.
+    """
+    if not is_jpeg(data):
+        return None
+    offset, order = _orientation_offset(data)
+    if offset is not None:
+        patched = bytearray(data)
+        patched[offset : offset + 2] = struct.pack(order + "H", orientation)
+        return patched
+    if order is not None:
+        return None
+    exif = (
+        b"Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08"
+        + struct.pack(">HHHIHH", 1, ORIENTATION_TAG, 3, 1, orientation, 0)
+        + b"\x00\x00\x00\x00"
+    )
+    segment = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+    # keep a JFIF APP0 segment first
+    insert_at = 2
+    for marker, start, length in _segments(data):
+        if marker == 0xE0:
+            insert_at = start + 2 + length
+        break
+    patched = bytearray(data[:insert_at])
+    patched += segment
+    patched += data[insert_at:]
+    return patched
@@ -4,11 +4,9 @@
 #
 # Copyright (c) 2018, Galen Curwen-McAdams
 
+import sys
 import argparse
-import inspect
-import keli.img_pipe
-import keli.src_pipe
-import keli.neo_pipe
+from keli.commands import command_class, command_names, method_name
 
 
 def main():
@@ -19,6 +17,11 @@ def main():
     parser.add_argument("--db-host", default="127.0.0.1", help="db host ip")
     parser.add_argument("--db-port", default=None, help="db port")
     parser.add_argument("--verbose", action="store_true", help="")
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="run in this process even if keli serve is running",
+    )
     args, unknown_args = parser.parse_known_args()
     args = vars(args)
 
@@ -35,46 +38,55 @@ def main():
         except Exception as ex:
             pass
 
-    if args["command"] == "list":
+    if args["command"] == "serve":
+        # keli serve --workers 4
+        import keli.keli_serve
+
+        keli.keli_serve.KeliService(
+            db_host=args["db_host"], db_port=args["db_port"], **unknown_args
+        ).serve()
+    elif args["command"] == "list":
         # list available commands
-        for c in [
-            keli.img_pipe.keli_img,
-            keli.src_pipe.keli_src,
-            keli.neo_pipe.keli_neo,
-        ]:
-            for method in [
-                method[0]
-                for method in inspect.getmembers(c(), predicate=inspect.ismethod)
-                if not method[0].startswith("__")
-            ]:
-                print(method.replace("_", "-"))
-                # print(inspect.getargspec(getattr(img_pipe.keli_img, method)))
+        for name in command_names():
+            print(name)
     elif args["key"] is None and args["field"] is None:
         # show command signature
-        for c in [
-            keli.img_pipe.keli_img,
-            keli.src_pipe.keli_src,
-            keli.neo_pipe.keli_neo,
-        ]:
-            try:
-                print(inspect.getargspec(getattr(c, args["command"].replace("-", "_"))))
-            except AttributeError:
-                pass
+        import inspect
+
+        try:
+            c = command_class(args["command"])
+            print(inspect.getfullargspec(getattr(c, method_name(args["command"]))))
+        except (KeyError, AttributeError):
+            pass
 
     else:
+        context = {"uuid": args["key"], "key": args["field"]}
+        if not args["no_daemon"]:
+            import keli.keli_serve
+
+            redis_conn = keli.keli_serve.connection(args["db_host"], args["db_port"])
+            if keli.keli_serve.running(redis_conn):
+                result = keli.keli_serve.submit(
+                    redis_conn, args["command"], context, unknown_args
+                )
+                print(result["output"], end="")
+                if "error" in result:
+                    print(result["error"], file=sys.stderr)
+                    sys.exit(1)
+                return
+
         # run command
-        for c in [
-            keli.img_pipe.keli_img,
-            keli.src_pipe.keli_src,
-            keli.neo_pipe.keli_neo,
-        ]:
-            try:
-                getattr(
-                    c(db_host=args["db_host"], db_port=args["db_port"]),
-                    args["command"].replace("-", "_"),
-                )({"uuid": args["key"], "key": args["field"]}, **unknown_args)
-            except AttributeError:
-                pass
+        try:
+            c = command_class(args["command"])
+        except KeyError:
+            c = None
+        if not hasattr(c, method_name(args["command"])):
+            print("unknown command {}".format(args["command"]), file=sys.stderr)
+            sys.exit(1)
+        getattr(
+            c(db_host=args["db_host"], db_port=args["db_port"]),
+            method_name(args["command"]),
+        )(context, **unknown_args)
 
 
 if __name__ == "__main__":
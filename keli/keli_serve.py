@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import io
+import os
+import sys
+import json
+import uuid
+import redis
+import logging
+import logzero
+import threading
+import traceback
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from ma_cli import data_models
+from keli.commands import COMMANDS, command_class, method_name
+
+# list of json encoded commands consumed by keli serve
+COMMAND_QUEUE = "keli:commands"
+# list the result of a command is pushed to, by command id
+RESULT_TEMPLATE = "keli:result:{}"
+# channel every result is also published on
+RESULT_CHANNEL = "keli:results"
+# present while a keli serve process is running
+HEARTBEAT_KEY = "keli:serve:heartbeat"
+HEARTBEAT_TTL = 5
+# seconds an unclaimed result is kept
+RESULT_TTL = 60
+# buffer of the command running in the current context
+OUTPUT_BUFFER = contextvars.ContextVar("output_buffer", default=None)
+
+
+def connection(db_host=None, db_port=None):
+    if db_port is None:
+        db_host, db_port = data_models.service_connection()
+    return redis.StrictRedis(host=db_host, port=db_port, decode_responses=True)
+
+
+class CommandOutput(io.TextIOBase):
+    """sys.stdout replacement capturing output per command
+
+    Commands print their output, so while a worker thread
+    runs a command its writes go to a buffer that is sent
+    back with the result, and so do log records of the
+    command. The buffer is kept in OUTPUT_BUFFER, commands
+    running work in their own threads, such as the
+    neo-slurpif captures, submit it in a copy of their
+    context to write to the same buffer. Writes outside a
+    command go to stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def current(self):
+        return OUTPUT_BUFFER.get()
+
+    def write(self, s):
+        buffer = self.current()
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    @contextmanager
+    def capture(self):
+        buffer = io.StringIO()
+        token = OUTPUT_BUFFER.set(buffer)
+        try:
+            yield buffer
+        finally:
+            OUTPUT_BUFFER.reset(token)
+
+    @contextmanager
+    def installed(self):
+        # replace sys.stdout and route logzero records of commands
+        # to their output, restoring both on exit
+        handler = OutputHandler(self)
+        daemon_handlers = list(logzero.logger.handlers)
+        for daemon_handler in daemon_handlers:
+            daemon_handler.addFilter(handler.uncaptured)
+        logzero.logger.addHandler(handler)
+        sys.stdout = self
+        try:
+            yield self
+        finally:
+            sys.stdout = self.stream
+            logzero.logger.removeHandler(handler)
+            for daemon_handler in daemon_handlers:
+                daemon_handler.removeFilter(handler.uncaptured)
+
+
+class OutputHandler(logging.Handler):
+    """Log handler writing records to the command output
+
+    Records logged while a command runs, for example by the
+    logzero logger of keli_img, are sent back to the client
+    instead of the daemon's handlers.
+    """
+
+    def __init__(self, output):
+        super().__init__()
+        self.output = output
+        self.setFormatter(logzero.LogFormatter(color=False))
+
+    def captured(self, record):
+        return self.output.current() is not None
+
+    def uncaptured(self, record):
+        return self.output.current() is None
+
+    def filter(self, record):
+        return self.captured(record) and super().filter(record)
+
+    def emit(self, record):
+        try:
+            self.output.current().write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+class KeliService(object):
+    """Run queued keli commands with warm state
+
+    Commands are json objects with id, command, uuid, key and
+    kwargs, the same shape keli_cli passes to a command. They
+    are popped from COMMAND_QUEUE and run by a pool of worker
+    threads sharing one keli_img, keli_src and keli_neo. Each
+    result is pushed to RESULT_TEMPLATE and published on
+    RESULT_CHANNEL with the command output or the error.
+    """
+
+    def __init__(self, db_host=None, db_port=None, workers=None):
+        self.redis_conn = connection(db_host, db_port)
+        self.instances = {
+            prefix: command_class(prefix)(db_host=db_host, db_port=db_port)
+            for prefix in COMMANDS
+        }
+        self.workers = int(workers or os.cpu_count() or 1)
+        self.running = threading.Event()
+
+    def method(self, command):
+        prefix = command.partition("-")[0]
+        if prefix in self.instances and hasattr(
+            self.instances[prefix], method_name(command)
+        ):
+            return getattr(self.instances[prefix], method_name(command))
+        raise ValueError("unknown command {}".format(command))
+
+    def run(self, request, output):
+        result = {"id": request["id"]}
+        with output.capture() as buffer:
+            try:
+                result["result"] = self.method(request["command"])(
+                    {"uuid": request["uuid"], "key": request["key"]},
+                    **request["kwargs"]
+                )
+            except Exception:
+                result["error"] = traceback.format_exc()
+        result["output"] = buffer.getvalue()
+        result = json.dumps(result, default=str)
+        pipe = self.redis_conn.pipeline()
+        pipe.rpush(RESULT_TEMPLATE.format(request["id"]), result)
+        pipe.expire(RESULT_TEMPLATE.format(request["id"]), RESULT_TTL)
+        pipe.publish(RESULT_CHANNEL, result)
+        pipe.execute()
+
+    def heartbeat(self):
+        while self.running.is_set():
+            self.redis_conn.set(HEARTBEAT_KEY, os.getpid(), ex=HEARTBEAT_TTL)
+            self.running.wait(1)
+        self.redis_conn.delete(HEARTBEAT_KEY)
+
+    def serve(self):
+        with CommandOutput(sys.stdout).installed() as output:
+            self.running.set()
+            beat = threading.Thread(target=self.heartbeat, daemon=True)
+            beat.start()
+            print("serving {} with {} workers".format(COMMAND_QUEUE, self.workers))
+            # commands are only popped when a worker is free, queued
+            # ones stay in redis if this process stops
+            free = threading.BoundedSemaphore(self.workers)
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    while True:
+                        if not free.acquire(timeout=1):
+                            continue
+                        popped = self.redis_conn.blpop(COMMAND_QUEUE, timeout=1)
+                        if popped is None:
+                            free.release()
+                            continue
+                        future = pool.submit(self.run, json.loads(popped[1]), output)
+                        future.add_done_callback(lambda future: free.release())
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.running.clear()
+                beat.join()
+
+
+def running(redis_conn):
+    return bool(redis_conn.exists(HEARTBEAT_KEY))
+
+
+def submit(redis_conn, command, context, kwargs=None):
+    """Queue a command for keli serve and wait for its result
+
+        Args:
+            command(str): command name as given to keli
+            context(dict): uuid and key of the command
+
+        Returns:
+            dict: id, output and result or error
+    """
+    command_id = str(uuid.uuid4())
+    redis_conn.rpush(
+        COMMAND_QUEUE,
+        json.dumps(
+            {
+                "id": command_id,
+                "command": command,
+                "uuid": context["uuid"],
+                "key": context["key"],
+                "kwargs": kwargs or {},
+            }
+        ),
+    )
+    while True:
+        popped = redis_conn.blpop(RESULT_TEMPLATE.format(command_id), timeout=1)
+        if popped is not None:
+            return json.loads(popped[1])
+        if not running(redis_conn):
+            return {"id": command_id, "output": "", "error": "keli serve stopped"}
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import time
+import hashlib
+import threading
+import collections
+import fold_ui.keyling as keyling
+
+
+class KeylingCache(object):
+    """Parsed keyling models keyed by a hash of the script text
+
+    Models are evicted least recently used first once maxsize
+    is reached. Scripts are read from settings lists with
+    scripts(), which also drops the models of scripts removed
+    from a list since it was last read.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.models = collections.OrderedDict()
+        # list key to the script hashes last read from it
+        self.lists = {}
+        self.hits = 0
+        self.parses = 0
+        self.parse_seconds = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def script_hash(script):
+        return hashlib.sha1(script.encode()).hexdigest()
+
+    def scripts(self, redis_conn, list_key):
+        scripts = redis_conn.lrange(list_key, 0, -1)
+        hashes = set(self.script_hash(script) for script in scripts)
+        with self.lock:
+            removed = self.lists.get(list_key, hashes) - hashes
+            self.lists[list_key] = hashes
+            if removed:
+                removed -= set().union(*self.lists.values())
+                for h in removed:
+                    self.models.pop(h, None)
+        return scripts
+
+    def model(self, script):
+        h = self.script_hash(script)
+        with self.lock:
+            if h in self.models:
+                self.models.move_to_end(h)
+                self.hits += 1
+                return self.models[h]
+        start = time.perf_counter()
+        model = keyling.model(script)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.parses += 1
+            self.parse_seconds += elapsed
+            self.models[h] = model
+            while len(self.models) > self.maxsize:
+                self.models.popitem(last=False)
+        return model
+
+    def stats(self):
+        with self.lock:
+            return {
+                "models": len(self.models),
+                "hits": self.hits,
+                "parses": self.parses,
+                "parse_seconds": self.parse_seconds,
+            }
+
+
+keyling_cache = KeylingCache()
@@ -5,14 +5,110 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import redis
-import pathlib
-import os
 import fnmatch
 import importlib
-import importlib.util
-import inspect
+import collections
+import collections.abc
+import threading
+import contextvars
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from ma_cli import data_models
 import fold_ui.keyling as keyling
+from keli.keyling_cache import keyling_cache
+from keli.blob_io import BLOB_REFS, BLOB_CANDIDATES, BINARY_VERSIONS_KEY, dedup_stats
+
+# names usable with --slurp-method and the class implementing
+# each as "module:class". A module is only imported when one of
+# its methods is used, so that for example gphoto2 is not
+# needed to take screenshots.
+#
+# Other packages can add methods with a "keli.slurp" entry
+# point, for example: scanner = mypackage.scan:SlurpScanner
+SLURP_PLUGINS = {
+    "gphoto2": "keli.slurp_gphoto2:SlurpGphoto2",
+    "webcam": "keli.slurp_webcam:SlurpWebCam",
+    "screenshot": "keli.slurp_screen:SlurpScreenshot",
+    "screenshotregion": "keli.slurp_screen:SlurpScreenshotRegion",
+    "screenshotwindow": "keli.slurp_screen:SlurpScreenshotWindow",
+    "screenshotanimated": "keli.slurp_screen:SlurpScreenshotAnimated",
+    "thing": "keli.slurpthing:SlurpThing",
+}
+SLURP_ENTRY_POINT_GROUP = "keli.slurp"
+
+
+def slurp_entry_points():
+    # name to "module:class" of installed keli.slurp entry points
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from pkg_resources import iter_entry_points
+
+        return {
+            e.name: "{}:{}".format(e.module_name, ".".join(e.attrs))
+            for e in iter_entry_points(SLURP_ENTRY_POINT_GROUP)
+        }
+    found = entry_points()
+    if hasattr(found, "select"):
+        found = found.select(group=SLURP_ENTRY_POINT_GROUP)
+    else:
+        found = found.get(SLURP_ENTRY_POINT_GROUP, [])
+    return {e.name: e.value for e in found}
+
+
+def unreferenced(count, rebuilt=False):
+    # whether a BLOB_REFS count allows deleting its blob. Counts
+    # below zero come from unreferencing blobs written before the
+    # index or set outside keli's writers and missing counts from
+    # blobs the index never saw, so both are untracked and kept
+    # unless the counts were just rebuilt from every hash
+    if count is None:
+        return rebuilt
+    return int(count) == 0
+
+
+class SlurpClasses(collections.abc.Mapping):
+    """Slurp method name to class, importing modules on access
+
+    Names are looked up in SLURP_PLUGINS first and then in
+    installed entry points, which are only read for names that
+    are not built in. "default" is the class named by default.
+    """
+
+    def __init__(self, default="gphoto2"):
+        self.default = default
+        self.loaded = {}
+        self._entry_points = None
+
+    def entry_points(self):
+        if self._entry_points is None:
+            self._entry_points = slurp_entry_points()
+        return self._entry_points
+
+    def _path(self, name):
+        if name == "default":
+            name = self.default
+        if name in SLURP_PLUGINS:
+            return SLURP_PLUGINS[name]
+        return self.entry_points()[name]
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            module, class_name = self._path(name).split(":")
+            self.loaded[name] = getattr(importlib.import_module(module), class_name)
+        return self.loaded[name]
+
+    def __iter__(self):
+        yield "default"
+        for name in SLURP_PLUGINS:
+            yield name
+        for name in self.entry_points():
+            if name not in SLURP_PLUGINS:
+                yield name
+
+    def __len__(self):
+        return len(list(iter(self)))
 
 
 class keli_neo(object):
@@ -29,63 +125,154 @@ class keli_neo(object):
             host=r_ip, port=r_port, decode_responses=True
         )
 
-        # discover slurp_* files and load Slurp* classes
-        self.slurp_classes = {}
+        # Slurp* classes by --slurp-method name, imported on use
         self.slurp_default_class = "gphoto2"
-        package_path = pathlib.Path(pathlib.Path(__file__).parents[0])
-        if package_path.is_dir():
-            slurp_files = list(
-                x for x in package_path.iterdir() if x.is_file() and "slurp_" in str(x)
-            )
-        for file in slurp_files:
-            # load modules using full path
-            spec = importlib.util.spec_from_file_location(pathlib.Path(file).stem, file)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            clsmembers = inspect.getmembers(module, inspect.isclass)
-            # create a dictionary of names that will be callable with
-            # the --slurp-method parameter
-            #
-            # ('SlurpGphoto2', <class 'slurp_gphoto2.SlurpGphoto2'>)
-            # will be used as
-            # {"gphoto2" : <class 'slurp_gphoto2.SlurpGphoto2'>}
-            #
-            self.slurp_classes.update(
-                {
-                    key.lower()[5:]: value
-                    for (key, value) in clsmembers
-                    if key.startswith("Slurp")
-                }
-            )
-        # set a default if --slurp-method is not used
-        self.slurp_classes["default"] = self.slurp_classes[self.slurp_default_class]
+        self.slurp_classes = SlurpClasses(default=self.slurp_default_class)
 
-    def neo_prune(self, context):
+    def neo_prune(
+        self, context, rebuild=False, dry_run=False, chunk_size=1000, **kwargs
+    ):
         #  context["uuid"] is a pattern glworb:*
         # context["key"] is a pattern binary:*
+        #
+        # by default only blobs that lost a reference since the
+        # last prune are visited, using the reference index kept
+        # by write_bytes and the slurpers. rebuild scans every
+        # hash to recount references, which is needed once for
+        # databases written before the index existed. Blobs
+        # with untracked counts are skipped until then.
+        chunk_size = int(chunk_size)
+        untracked = 0
+        if rebuild:
+            blobs = self._rebuild_refs(context, chunk_size, dry_run)
+        else:
+            candidates = [
+                c
+                for c in self.redis_conn.smembers(BLOB_CANDIDATES)
+                if fnmatch.fnmatch(c, context["key"])
+            ]
+            counts = self.redis_conn.hmget(BLOB_REFS, candidates) if candidates else []
+            blobs = [c for c, count in zip(candidates, counts) if unreferenced(count)]
+            untracked = sum(1 for count in counts if count is None or int(count) < 0)
+            if not dry_run and candidates:
+                self.redis_conn.srem(BLOB_CANDIDATES, *candidates)
+
+        deleted, reclaimed = self._delete_blobs(blobs, chunk_size, dry_run, rebuild)
+        print(
+            "{}{} unreferenced blobs, {} bytes reclaimed".format(
+                "dry run: " if dry_run else "", deleted, reclaimed
+            )
+        )
+        if untracked:
+            print(
+                "{} blobs with untracked references kept, "
+                "prune once with --rebuild 1 to count them".format(untracked)
+            )
+        context["pruned"] = deleted
+        context["reclaimed_bytes"] = reclaimed
+        return context
+
+    def _rebuild_refs(self, context, chunk_size, dry_run):
+        # count references streaming hashes in pipelined chunks,
+        # returns an iterator of unreferenced blob keys
+        refs = collections.Counter()
+        hashes = self.redis_conn.scan_iter(match=context["uuid"], count=chunk_size)
+        while True:
+            chunk = [h for _, h in zip(range(chunk_size), hashes)]
+            if not chunk:
+                break
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for h in chunk:
+                pipe.hvals(h)
+            for values in pipe.execute():
+                refs.update(v for v in values if fnmatch.fnmatch(v, context["key"]))
+
+        if not dry_run:
+            pipe = self.redis_conn.pipeline()
+            pipe.delete(BLOB_REFS, BLOB_CANDIDATES)
+            items = list(refs.items())
+            for start in range(0, len(items), chunk_size):
+                pipe.hmset(BLOB_REFS, dict(items[start : start + chunk_size]))
+            pipe.execute()
+
+        return (
+            blob
+            for blob in self.redis_conn.scan_iter(
+                match=context["key"], count=chunk_size
+            )
+            if blob not in refs
+        )
 
-        hashes = list(self.redis_conn.scan_iter(match=context["uuid"]))
-        is_referenced = set(list(self.redis_conn.scan_iter(match=context["key"])))
+    def _delete_blobs(self, blobs, chunk_size, dry_run, rebuilt=False):
+        # delete in pipelined chunks, returns (count, bytes)
+        deleted = 0
+        reclaimed = 0
+        blobs = iter(blobs)
+        while True:
+            chunk = [b for _, b in zip(range(chunk_size), blobs)]
+            if not chunk:
+                break
+            if dry_run:
+                pipe = self.redis_conn.pipeline(transaction=False)
+                for blob in chunk:
+                    pipe.strlen(blob)
+                reclaimed += sum(pipe.execute())
+                deleted += len(chunk)
+                continue
+            with self.redis_conn.pipeline() as pipe:
+                while True:
+                    try:
+                        # a content addressed store may reference a
+                        # blob again while it is being pruned, the
+                        # transaction is retried if any count changes
+                        pipe.watch(BLOB_REFS)
+                        counts = pipe.hmget(BLOB_REFS, chunk)
+                        deleting = [
+                            b
+                            for b, count in zip(chunk, counts)
+                            if unreferenced(count, rebuilt)
+                        ]
+                        sizes = [pipe.strlen(b) for b in deleting]
+                        pipe.multi()
+                        if deleting:
+                            pipe.delete(*deleting)
+                            pipe.hdel(BLOB_REFS, *deleting)
+                            pipe.hdel(BINARY_VERSIONS_KEY, *deleting)
+                        pipe.execute()
+                        break
+                    except redis.WatchError:
+                        continue
+            reclaimed += sum(sizes)
+            deleted += len(deleting)
+        return deleted, reclaimed
 
-        for h in hashes:
-            contents = self.redis_conn.hgetall(h)
-            for k, v in contents.items():
-                if v in is_referenced:
-                    is_referenced.remove(v)
+    def neo_dedup_stats(self, context, **kwargs):
+        # blobs stored and skipped since content addressed keys
+        # were enabled with KELI_CONTENT_ADDRESSED=1
+        stats = dedup_stats(self.redis_conn)
+        print(
+            "{deduplicated} of {total} blobs deduplicated ({dedup_ratio:.1%}), "
+            "{bytes_saved} bytes saved".format(
+                total=stats["written"] + stats["deduplicated"], **stats
+            )
+        )
+        context["dedup_stats"] = stats
+        return context
 
-        for not_referenced in is_referenced:
-            self.redis_conn.delete(not_referenced)
+    def _slurp_class(self, kwargs):
+        # only the requested slurp method is imported, default
+        # is used if it is unknown
+        try:
+            return self.slurp_classes[kwargs.get("slurp_method", "default")]
+        except KeyError as ex:
+            print(ex)
+            return self.slurp_classes["default"]
 
     def neo_slurpif(self, context, **kwargs):
         # use context["uuid"] for device uid using pattern matching
         # for example "*" will match all devices
         # this is  messy since it expects keli_cli parsing behavior
-        slurp_class = self.slurp_classes["default"]
-        if "slurp_method" in kwargs:
-            try:
-                slurp_class = self.slurp_classes[kwargs["slurp_method"]]
-            except KeyError as ex:
-                print(ex)
+        slurp_class = self._slurp_class(kwargs)
         slurp_thing = slurp_class(binary_r=self.binary_r, redis_conn=self.redis_conn)
 
         env_var_key = "machinic:env:{}:{}".format(self.db_host, self.db_port)
@@ -102,7 +289,7 @@ class keli_neo(object):
         # settings:pre:foo:127.0.0.1:6379 #list of keyling scripts
         # settings:set:foo:127.0.0.1:6379 #hash of key:values to set
         # settings:post:foo:127.0.0.1:6379 #list of keyling scripts
-        found_devices = slurp_thing.discover()
+        found_devices = slurp_thing.discover(refresh=kwargs.get("refresh", False))
         devices = []
         print("found devices", found_devices)
         # use underscore to match all
@@ -114,7 +301,13 @@ class keli_neo(object):
                 devices.append(d)
 
         print("using devices:", devices)
-        for device in devices:
+        # evaluate conditions and collect the satisfied ones for
+        # each device, devices are then captured concurrently.
+        # Devices are keyed by position since cameras without a
+        # serial number and virtual devices share an empty uid,
+        # the uid only selects their settings
+        captures = collections.OrderedDict()
+        for position, device in enumerate(devices):
             pre_conditions = list(
                 self.redis_conn.scan_iter(
                     match="settings:pre:*:{}:{}:{}".format(
@@ -123,10 +316,10 @@ class keli_neo(object):
                 )
             )
             for c in pre_conditions:
-                conditions = self.redis_conn.lrange(c, 0, -1)
+                conditions = keyling_cache.scripts(self.redis_conn, c)
                 all_satisfied = []
                 for condition in conditions:
-                    model = keyling.model(condition)
+                    model = keyling_cache.model(condition)
                     satisfied = keyling.parse_lines(
                         model, env_vars, env_var_key, allow_shell_calls=True
                     )
@@ -137,48 +330,136 @@ class keli_neo(object):
                 # and did not return a dictionary
                 if None not in all_satisfied:
                     print(all_satisfied)
+                    captures.setdefault(position, (device, []))[1].append(c)
+
+        if not captures:
+            print("keyling models:", keyling_cache.stats())
+            return
+
+        # with --sync 1 each round of captures waits on a barrier
+        # so that devices fire together, for example left and
+        # right pages of a book scanner
+        rounds = max(len(satisfied) for _, satisfied in captures.values())
+        barriers = []
+        if kwargs.get("sync"):
+            barriers = [
+                threading.Barrier(
+                    sum(len(satisfied) > i for _, satisfied in captures.values()),
+                    timeout=kwargs.get("sync_timeout", 10),
+                )
+                for i in range(rounds)
+            ]
+        capture_group = str(uuid.uuid4())
+        results = []
+        with ThreadPoolExecutor(max_workers=len(captures)) as pool:
+            # each capture runs in a copy of this context, which
+            # keeps their output with the command under keli serve
+            futures = [
+                pool.submit(
+                    contextvars.copy_context().run,
+                    self._slurp_device,
+                    slurp_class,
+                    device,
+                    satisfied,
+                    barriers,
+                    capture_group,
+                    kwargs.get("preview"),
+                )
+                for device, satisfied in captures.values()
+            ]
+            for future in futures:
+                try:
+                    results.extend(future.result())
+                except Exception as ex:
+                    print(ex)
+
+        # skew is the spread of capture start times in a round
+        started = collections.defaultdict(list)
+        for capture_round, c, capture_started, slurped in results:
+            started[capture_round].append(capture_started)
+        pipe = self.redis_conn.pipeline()
+        for capture_round, c, capture_started, slurped in results:
+            skew = max(started[capture_round]) - min(started[capture_round])
+            for s in slurped:
+                pipe.hset(s, "capture_skew", skew)
+        pipe.execute()
+        for capture_round, times in sorted(started.items()):
+            print(
+                "round {}: {} devices, skew {:.3f}s".format(
+                    capture_round, len(times), max(times) - min(times)
+                )
+            )
+
+        for capture_round, c, capture_started, slurped in results:
+            print(slurped)
+            post_conditions = keyling_cache.scripts(
+                self.redis_conn, c.replace("pre", "post")
+            )
+            postmodels = [keyling_cache.model(p) for p in post_conditions]
 
-                    # settings could be a list of raw strings or a dictionary
-                    # or use a raw_ prefix on key to specify raw string to use set_raw()
-                    # settings = self.redis_conn.lrange(c.replace("pre", "set"), 0, -1)
-                    settings = self.redis_conn.hgetall(c.replace("pre", "set"))
-                    devices = slurp_thing.discover()
-                    # set settings
-                    for setting, setting_value in settings.items():
-                        print(device, setting)
-                        slurp_thing.set_setting(device, setting, setting_value)
-
-                    # slurp returns a list of keys for hashes
-                    # for now this only calls slurp, but it may be useful
-                    # to make other calls such as adjusting servos for device positioning
-                    # or that could be done using shell calls at the tail of the preconditions
-                    slurped = slurp_thing.slurp()
-                    print(slurped)
-                    post_conditions = self.redis_conn.lrange(
-                        c.replace("pre", "post"), 0, -1
+            # get hashes and feed them into post_conditions keyling scripts
+            for s in slurped:
+                s_dict = self.redis_conn.hgetall(s)
+                for postmodel in postmodels:
+                    s_result = keyling.parse_lines(
+                        postmodel, s_dict, s, allow_shell_calls=True
                     )
+                    print(s_result)
+        print("keyling models:", keyling_cache.stats())
+
+    def _slurp_device(
+        self, slurp_class, device, pre_conditions, barriers, capture_group, preview
+    ):
+        # runs in a worker thread for each device, captures once
+        # for each satisfied condition and returns a list of
+        # (round, condition, capture start time, slurped keys)
+        slurp_thing = slurp_class(binary_r=self.binary_r, redis_conn=self.redis_conn)
+        results = []
+        try:
+            for capture_round, c in enumerate(pre_conditions):
+                # settings could be a list of raw strings or a dictionary
+                # or use a raw_ prefix on key to specify raw string to use set_raw()
+                # settings = self.redis_conn.lrange(c.replace("pre", "set"), 0, -1)
+                settings = self.redis_conn.hgetall(c.replace("pre", "set"))
+                for setting, setting_value in settings.items():
+                    print(device, setting)
+                    slurp_thing.set_setting(device, setting, setting_value)
 
-                    # get hashes and feed them into post_conditions keyling scripts
-                    for s in slurped:
-                        s_dict = self.redis_conn.hgetall(s)
-                        for post_condition in post_conditions:
-                            postmodel = keyling.model(post_condition)
-                            s_result = keyling.parse_lines(
-                                postmodel, s_dict, s, allow_shell_calls=True
-                            )
-                            print(s_result)
+                if barriers:
+                    try:
+                        barriers[capture_round].wait()
+                    except threading.BrokenBarrierError:
+                        print("capture not synchronized: {}".format(device["uid"]))
+
+                # slurp returns a list of keys for hashes
+                # for now this only calls slurp, but it may be useful
+                # to make other calls such as adjusting servos for device positioning
+                # or that could be done using shell calls at the tail of the preconditions
+                capture_started = time.time()
+                slurped = slurp_thing.slurp(
+                    device=device,
+                    preview=preview,
+                    metadata={
+                        "capture_group": capture_group,
+                        "capture_round": capture_round,
+                        "capture_started": capture_started,
+                    },
+                )
+                results.append((capture_round, c, capture_started, slurped))
+        except Exception:
+            # release devices waiting on captures this one will
+            # not make
+            for barrier in barriers:
+                barrier.abort()
+            raise
+        return results
 
     def neo_slurpst(self, context, state_template=None, **kwargs):
         # slurpstate
         # use context["uuid"] for device uid using pattern matching
         # for example "*" will match all devices
         # this is  messy since it expects keli_cli parsing behavior
-        slurp_class = self.slurp_classes["default"]
-        if "slurp_method" in kwargs:
-            try:
-                slurp_class = self.slurp_classes[kwargs["slurp_method"]]
-            except KeyError as ex:
-                print(ex)
+        slurp_class = self._slurp_class(kwargs)
         slurp_thing = slurp_class(binary_r=self.binary_r, redis_conn=self.redis_conn)
 
         found_devices = slurp_thing.discover()
@@ -203,34 +484,30 @@ class keli_neo(object):
             for setting, setting_value in settings.items():
                 slurp_thing.set_setting(device, setting, setting_value)
 
-            print("\n".join(slurp_thing.slurp()))
+            print("\n".join(slurp_thing.slurp(preview=kwargs.get("preview"))))
 
     def neo_slurp(self, context, **kwargs):
-        slurp_class = self.slurp_classes["default"]
-        if "slurp_method" in kwargs:
-            try:
-                slurp_class = self.slurp_classes[kwargs["slurp_method"]]
-            except KeyError as ex:
-                print(ex)
+        slurp_class = self._slurp_class(kwargs)
         slurp_thing = slurp_class(binary_r=self.binary_r, redis_conn=self.redis_conn)
-        print("\n".join(slurp_thing.slurp()))
+        print("\n".join(slurp_thing.slurp(preview=kwargs.get("preview"))))
 
     def neo_discover(self, context, **kwargs):
-        slurp_class = self.slurp_classes["default"]
-        if "slurp_method" in kwargs:
-            try:
-                slurp_class = self.slurp_classes[kwargs["slurp_method"]]
-            except KeyError as ex:
-                print(ex)
-
+        slurp_class = self._slurp_class(kwargs)
         slurp_thing = slurp_class(binary_r=self.binary_r, redis_conn=self.redis_conn)
-        print(slurp_thing.discover())
+        # --refresh 1 discovers again instead of using the device registry
+        print(slurp_thing.discover(refresh=kwargs.get("refresh", False)))
 
     def neo_discovery(self, context, **kwargs):
         # runs discover on all slurp classes
-        for name, slurp_class in self.slurp_classes.items():
+        for name in self.slurp_classes:
             print("{}:".format(name))
+            try:
+                slurp_class = self.slurp_classes[name]
+            except ImportError as ex:
+                # for example gphoto2 is not installed
+                print(ex)
+                continue
             slurp_thing = slurp_class(
                 binary_r=self.binary_r, redis_conn=self.redis_conn
             )
-            print(slurp_thing.discover())
+            print(slurp_thing.discover(refresh=kwargs.get("refresh", False)))
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import json
+import hashlib
+import functools
+from tesserocr import tesseract_version
+
+OCR_CACHE_PREFIX = "ocr_cache:"
+OCR_CACHE_STATS = "ocr_cache_stats"
+# seconds an unused result is kept, refreshed on every hit
+OCR_CACHE_TTL = 7 * 24 * 60 * 60
+
+
+@functools.lru_cache(maxsize=1)
+def engine_version():
+    return tesseract_version().split("\n")[0]
+
+
+class OcrCache(object):
+    """OCR results keyed by image content and ocr parameters
+
+    Keys are a hash of the blob digest, the parameters (region,
+    psm, lang, decoded size) and the tesseract version. Entries
+    expire after ttl seconds without a hit so that rarely used
+    results are evicted first.
+    """
+
+    def __init__(self, redis_conn, ttl=OCR_CACHE_TTL):
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+
+    def key(self, digest, params):
+        fingerprint = json.dumps(
+            [digest, engine_version(), sorted(params.items())], default=str
+        )
+        return OCR_CACHE_PREFIX + hashlib.sha1(fingerprint.encode()).hexdigest()
+
+    def lookup_many(self, digest, params_list):
+        # returns a list of results, None for misses
+        keys = [self.key(digest, params) for params in params_list]
+        found = self.redis_conn.mget(keys)
+        results = []
+        saved = 0
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key, entry in zip(keys, found):
+            if entry is None:
+                results.append(None)
+                continue
+            entry = json.loads(entry)
+            saved += entry["seconds"]
+            results.append(entry["text"])
+            pipe.expire(key, self.ttl)
+        hits = len(results) - results.count(None)
+        pipe.hincrby(OCR_CACHE_STATS, "hits", hits)
+        pipe.hincrby(OCR_CACHE_STATS, "misses", len(results) - hits)
+        pipe.hincrbyfloat(OCR_CACHE_STATS, "saved_seconds", saved)
+        pipe.execute()
+        return results
+
+    def lookup(self, digest, params):
+        return self.lookup_many(digest, [params])[0]
+
+    def store(self, digest, params, text, seconds):
+        self.redis_conn.set(
+            self.key(digest, params),
+            json.dumps({"text": text, "seconds": seconds}),
+            ex=self.ttl,
+        )
+
+    def stats(self):
+        stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+        for k, v in self.redis_conn.hgetall(OCR_CACHE_STATS).items():
+            stats[k] = float(v) if k == "saved_seconds" else int(v)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
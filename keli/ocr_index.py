@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import sys
+import struct
+from array import array
+
+# magic, box count, text byte length, image width, image height
+HEADER = struct.Struct("<4sIIII")
+MAGIC = b"KBX1"
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def pack_boxes(boxes, size=(0, 0)):
+    """Pack ocr boxes into bytes
+
+    boxes is a sequence of (x, y, w, h, confidence, text). The
+    packed form is a header followed by int32 coordinates,
+    float32 confidences, uint32 text offsets and utf-8 text.
+    """
+    coords = array("i")
+    confidences = array("f")
+    offsets = array("I", [0])
+    text = bytearray()
+    for x, y, w, h, confidence, box_text in boxes:
+        coords.extend((int(x), int(y), int(w), int(h)))
+        confidences.append(float(confidence))
+        text += box_text.encode()
+        offsets.append(len(text))
+    return b"".join(
+        [
+            HEADER.pack(MAGIC, len(confidences), len(text), *size),
+            _little_endian(coords).tobytes(),
+            _little_endian(confidences).tobytes(),
+            _little_endian(offsets).tobytes(),
+            bytes(text),
+        ]
+    )
+
+
+class BoxIndex(object):
+    """Query packed ocr boxes without running tesseract"""
+
+    def __init__(self, data):
+        data = memoryview(data)
+        magic, count, text_length, width, height = HEADER.unpack(data[: HEADER.size])
+        if magic != MAGIC:
+            raise ValueError("not a packed box index")
+        self.size = (width, height)
+        pos = HEADER.size
+        self.coords = array("i")
+        self.coords.frombytes(data[pos : pos + count * 16])
+        pos += count * 16
+        self.confidences = array("f")
+        self.confidences.frombytes(data[pos : pos + count * 4])
+        pos += count * 4
+        self.offsets = array("I")
+        self.offsets.frombytes(data[pos : pos + (count + 1) * 4])
+        pos += (count + 1) * 4
+        for values in (self.coords, self.confidences, self.offsets):
+            _little_endian(values)
+        self.text = bytes(data[pos : pos + text_length])
+
+    def __len__(self):
+        return len(self.confidences)
+
+    def box_text(self, i):
+        return self.text[self.offsets[i] : self.offsets[i + 1]].decode()
+
+    def box(self, i):
+        x, y, w, h = self.coords[i * 4 : i * 4 + 4]
+        return {
+            "x": x,
+            "y": y,
+            "w": w,
+            "h": h,
+            "confidence": self.confidences[i],
+            "text": self.box_text(i),
+        }
+
+    def intersecting(self, left, top, width, height):
+        # indices of boxes that intersect the rectangle
+        right = left + width
+        bottom = top + height
+        coords = self.coords
+        found = []
+        for i in range(len(self)):
+            x, y, w, h = coords[i * 4 : i * 4 + 4]
+            if x < right and x + w > left and y < bottom and y + h > top:
+                found.append(i)
+        return found
+
+    def text_in(self, left, top, width, height, min_confidence=0):
+        return "".join(
+            self.box_text(i)
+            for i in self.intersecting(left, top, width, height)
+            if self.confidences[i] >= min_confidence
+        )
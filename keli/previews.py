@@ -0,0 +1,50 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import io
+from PIL import Image
+from keli import blob_io
+
+# largest dimension of previews written at slurp time
+PREVIEW_SIZE = 1600
+
+
+def preview_field(key):
+    # hash field holding the preview of the image in key
+    return "{}_preview".format(key)
+
+
+def reduced_image(image, max_size):
+    """Reduce a just opened image to fit within max_size
+
+    For JPEG this uses draft mode so that the decoder
+    itself scales down instead of decoding every pixel.
+    """
+    image.thumbnail((max_size, max_size))
+    return image
+
+
+def preview_bytes(image_bytes, max_size=PREVIEW_SIZE):
+    # returns None for formats PIL cannot decode, such as raw
+    try:
+        image = reduced_image(Image.open(io.BytesIO(image_bytes)), max_size)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        file = io.BytesIO()
+        image.save(file, "JPEG", quality=85)
+        return file.getvalue()
+    except (IOError, ValueError, OSError):
+        return None
+
+
+def write_preview(
+    binary_r, glworb, image_bytes, key="binary_key", max_size=PREVIEW_SIZE
+):
+    # store a preview blob and add its field to the glworb dict
+    preview = preview_bytes(image_bytes, max_size=int(max_size))
+    if preview is not None:
+        glworb[preview_field(key)] = blob_io.store_blob(binary_r, binary_r, preview)
+    return glworb
@@ -12,6 +12,10 @@ import redis
 import time
 import subprocess
 from ma_cli import data_models
+from keli import blob_io
+from keli.previews import write_preview
+from keli.device_registry import DeviceRegistry
+from keli.camera_session import camera_session
 
 # chdkptp needs to be installed/linked in a callable path
 # to set settings
@@ -31,39 +35,53 @@ class SlurpGphoto2(object):
             )
             self.binary_r = redis.StrictRedis(host=db_host, port=str(db_port))
 
-    def discover(self):
+    def discover(self, refresh=False):
         method = "gphoto2"
-        discoverable = []
-        context = gp.Context()
-        try:
-            for name, addr in context.camera_autodetect():
-                now = str(datetime.datetime.now())
-                c = gp.Context()
-                camera = gp.Camera()
-                camera.init(c)
-                camera_summary = camera.get_summary(c)
-                serial = ""
-                for t in str(camera_summary).split("\n"):
-                    if ("Serial Number:") in t:
-                        serial = t.partition(":")[-1].strip()
-                        # print(serial)
-                        break
-                camera.exit(c)
-                discoverable.append(
-                    {
+        registry = DeviceRegistry(self.redis_conn, method)
+        discoverable = None if refresh else registry.devices()
+        if discoverable is None:
+            found = {}
+            try:
+                context = gp.Context()
+                for name, addr in context.camera_autodetect():
+                    found[addr] = {
                         "name": name,
                         "address": addr,
-                        "uid": serial,
+                        "uid": "",
                         "discovery": method,
-                        "lastseen": now,
                     }
-                )
+            except Exception as ex:
+                print(ex)
+                return []
+            discoverable = registry.refresh(found, probe=self.probe)
+        return discoverable
 
+    def probe(self, device):
+        # initializing a camera to read its serial number is
+        # slow, the registry only calls this for new addresses
+        try:
+            c = gp.Context()
+            camera = gp.Camera()
+            cameras = gp.PortInfoList()
+            cameras.load()
+            camera_address = cameras.lookup_path(device["address"])
+            camera.set_port_info(cameras[camera_address])
+            camera.init(c)
+            camera_summary = camera.get_summary(c)
+            for t in str(camera_summary).split("\n"):
+                if ("Serial Number:") in t:
+                    device["uid"] = t.partition(":")[-1].strip()
+                    break
+            abilities = camera.get_abilities()
+            device["model"] = abilities.model
+            device["capabilities"] = abilities.operations
+            camera.exit(c)
         except Exception as ex:
             print(ex)
-        return discoverable
+            return None
+        return device
 
-    def slurp(self, device=None, container="glworb", metadata=None):
+    def slurp(self, device=None, container="glworb", metadata=None, preview=None):
         if device == "_":
             device = None
 
@@ -92,9 +110,9 @@ class SlurpGphoto2(object):
                 slurped.append(slurped_bytes)
 
             if "glworb" in container:
-                blob_uuid = str(uuid.uuid4())
-                blob_uuid = "binary:" + blob_uuid
-                self.binary_r.set(blob_uuid, slurped_bytes)
+                blob_uuid = blob_io.store_blob(
+                    self.binary_r, self.redis_conn, slurped_bytes
+                )
 
                 glworb = {}
                 glworb["uuid"] = str(uuid.uuid4())
@@ -105,6 +123,12 @@ class SlurpGphoto2(object):
                 glworb["created"] = str(datetime.datetime.now())
                 for k, v in metadata.items():
                     glworb[k] = v
+                # preview is the largest dimension of an optional
+                # reduced copy for commands that do not need full size
+                if preview:
+                    write_preview(
+                        self.binary_r, glworb, slurped_bytes, max_size=preview
+                    )
                 glworb_uuid = "glworb:{}".format(glworb["uuid"])
                 self.redis_conn.hmset(glworb_uuid, glworb)
                 slurped.append(glworb_uuid)
@@ -158,39 +182,12 @@ class SlurpGphoto2(object):
     def slurpd(self, device):
         contents = b""
         try:
-            context = gp.gp_context_new()
-            camera = gp.Camera()
-
-            cameras = gp.PortInfoList()
-            cameras.load()
-            camera_address = cameras.lookup_path(device["address"])
-            camera.set_port_info(cameras[camera_address])
-            gp.check_result(gp.gp_camera_init(camera, context))
-
-            captured = gp.check_result(
-                gp.gp_camera_capture(camera, gp.GP_CAPTURE_IMAGE, context)
-            )
-
-            captured_file = gp.check_result(
-                gp.gp_camera_file_get(
-                    camera,
-                    captured.folder,
-                    captured.name,
-                    gp.GP_FILE_TYPE_NORMAL,
-                    context,
-                )
-            )
-
-            captured_file_data = gp.check_result(
-                gp.gp_file_get_data_and_size(captured_file)
-            )
-            container = io.BytesIO(memoryview(captured_file_data))
-            container.seek(0)
-            contents = container.read()
-
-            gp.check_result(gp.gp_camera_exit(camera, context))
-
+            # the session keeps cameras initialized between shots
+            contents = camera_session.capture(device["address"])
         except Exception as ex:
             print(ex)
+            # the camera may have been reconnected at another
+            # address, discover it again on the next call
+            DeviceRegistry(self.redis_conn, "gphoto2").invalidate()
 
         return contents
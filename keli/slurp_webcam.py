@@ -14,6 +14,9 @@ import subprocess
 import fnmatch
 import glob
 from ma_cli import data_models
+from keli import blob_io
+from keli.previews import write_preview
+from keli.device_registry import DeviceRegistry
 
 
 class SlurpWebCam(object):
@@ -96,28 +99,28 @@ class SlurpWebCam(object):
                 )
         return get_values
 
-    def discover(self):
+    def discover(self, refresh=False):
 
         method = "webcam"
-        discoverable = []
-        try:
-            now = str(datetime.datetime.now())
-            for webcam in glob.glob("/dev/video*"):
-                discoverable.append(
-                    {
+        registry = DeviceRegistry(self.redis_conn, method)
+        discoverable = None if refresh else registry.devices()
+        if discoverable is None:
+            found = {}
+            try:
+                for webcam in glob.glob("/dev/video*"):
+                    found[webcam] = {
                         "name": webcam,
                         "address": webcam,
                         "uid": webcam,
                         "discovery": method,
-                        "lastseen": now,
                     }
-                )
-        except Exception as ex:
-            print(ex)
+            except Exception as ex:
+                print(ex)
+            discoverable = registry.refresh(found)
 
         return discoverable
 
-    def slurp(self, device=None, container="glworb"):
+    def slurp(self, device=None, container="glworb", metadata=None, preview=None):
 
         if device == "_":
             device = None
@@ -127,6 +130,9 @@ class SlurpWebCam(object):
         else:
             devices = [device]
 
+        if metadata is None:
+            metadata = {}
+
         slurped = []
 
         for device in devices:
@@ -144,9 +150,9 @@ class SlurpWebCam(object):
                 slurped.append(slurped_bytes)
 
             if "glworb" in container:
-                blob_uuid = str(uuid.uuid4())
-                blob_uuid = "binary:" + blob_uuid
-                self.binary_r.set(blob_uuid, slurped_bytes)
+                blob_uuid = blob_io.store_blob(
+                    self.binary_r, self.redis_conn, slurped_bytes
+                )
 
                 glworb = {}
                 glworb["uuid"] = str(uuid.uuid4())
@@ -155,7 +161,15 @@ class SlurpWebCam(object):
                 glworb["slurp_source_name"] = device["name"]
                 glworb["binary_key"] = blob_uuid
                 glworb["created"] = str(datetime.datetime.now())
-
+                for k, v in metadata.items():
+                    glworb[k] = v
+
+                # preview is the largest dimension of an optional
+                # reduced copy for commands that do not need full size
+                if preview:
+                    write_preview(
+                        self.binary_r, glworb, slurped_bytes, max_size=preview
+                    )
                 glworb_uuid = "glworb:{}".format(glworb["uuid"])
                 self.redis_conn.hmset(glworb_uuid, glworb)
 
@@ -166,7 +180,8 @@ class SlurpWebCam(object):
     def slurpd(self, device):
 
         try:
-            tmp_output_filename = "/tmp/slurp_webcam.jpg"
+            # unique per capture so devices can be captured concurrently
+            tmp_output_filename = "/tmp/slurp_webcam_{}.jpg".format(uuid.uuid4())
             print(device)
             # name = device["name"]
             addr = device["address"]
@@ -182,12 +197,7 @@ class SlurpWebCam(object):
                     "1280x960",
                 ]
             )
-            contents = io.BytesIO()
-
-            with open(tmp_output_filename, "rb") as f:
-                contents = io.BytesIO(f.read())
-
-            contents = contents.getvalue()
+            contents = blob_io.file_bytes(tmp_output_filename, delete_file=True)
 
         except Exception as ex:
             print(ex)
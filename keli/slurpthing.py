@@ -11,6 +11,9 @@ import redis
 import time
 import subprocess
 from ma_cli import data_models
+from keli import blob_io
+from keli.previews import write_preview
+from keli.device_registry import DeviceRegistry
 
 # chdkptp needs to be installed/linked in a callable path
 # to set settings
@@ -32,29 +35,33 @@ class SlurpThing(object):
             )
             self.binary_r = redis.StrictRedis(host=db_host, port=str(db_port))
 
-    def discover(self):
+    def discover(self, refresh=False):
         # discovery method here
         discoverable = []
         # virtual keys for classes that set
         # self.virtual_device_pattern
         if self.virtual_device_pattern is not None:
-            for discovered in self.redis_conn.scan_iter(
-                match=self.virtual_device_pattern
-            ):
-                defaults = {
-                    "name": "",
-                    "address": "virtual",
-                    "uid": "",
-                    "discovery": self.slurp_method,
-                    "lastseen": str(datetime.datetime.now()),
-                }
-                # only update with keys from defaults?
-                # name and uid important
-                defaults.update(self.redis_conn.hgetall(discovered))
-                discoverable.append(defaults)
+            registry = DeviceRegistry(self.redis_conn, self.slurp_method)
+            discoverable = None if refresh else registry.devices()
+            if discoverable is None:
+                found = {}
+                for discovered in self.redis_conn.scan_iter(
+                    match=self.virtual_device_pattern
+                ):
+                    defaults = {
+                        "name": "",
+                        "address": "virtual",
+                        "uid": "",
+                        "discovery": self.slurp_method,
+                    }
+                    # only update with keys from defaults?
+                    # name and uid important
+                    defaults.update(self.redis_conn.hgetall(discovered))
+                    found[discovered] = defaults
+                discoverable = registry.refresh(found)
         return discoverable
 
-    def slurp(self, device=None, container="glworb", metadata=None):
+    def slurp(self, device=None, container="glworb", metadata=None, preview=None):
         if device == "_":
             device = None
 
@@ -82,9 +89,9 @@ class SlurpThing(object):
                 slurped.append(slurped_bytes)
 
             if "glworb" in container:
-                blob_uuid = str(uuid.uuid4())
-                blob_uuid = "binary:" + blob_uuid
-                self.binary_r.set(blob_uuid, slurped_bytes)
+                blob_uuid = blob_io.store_blob(
+                    self.binary_r, self.redis_conn, slurped_bytes
+                )
 
                 glworb = {}
                 glworb["uuid"] = str(uuid.uuid4())
@@ -98,6 +105,12 @@ class SlurpThing(object):
                     pass
                 for k, v in metadata.items():
                     glworb[k] = v
+                # preview is the largest dimension of an optional
+                # reduced copy for commands that do not need full size
+                if preview:
+                    write_preview(
+                        self.binary_r, glworb, slurped_bytes, max_size=preview
+                    )
                 glworb_uuid = "glworb:{}".format(glworb["uuid"])
                 self.redis_conn.hmset(glworb_uuid, glworb)
                 slurped.append(glworb_uuid)
@@ -126,10 +139,4 @@ class SlurpThing(object):
         return contents
 
     def file_bytes(self, filename, delete_file=False):
-        contents = io.BytesIO()
-
-        with open(filename, "rb") as f:
-            contents = io.BytesIO(f.read())
-
-        contents = contents.getvalue()
-        return contents
+        return blob_io.file_bytes(filename, delete_file=delete_file)
@@ -7,8 +7,81 @@
 import redis
 import pathlib
 import os
+import io
+import re
+import time
+import string
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from ma_cli import data_models
 from lings import ruling
+from keli.blob_io import blob_to_file, iter_blob
+
+# hash of item to position for a structured sequence list
+SEQUENCE_INDEX_TEMPLATE = "index:position:{}"
+
+
+# standard format spec, for example >8, +.2f or 04
+FORMAT_SPEC = re.compile(
+    r"(?:.?(?P<align>[<>=^]))?(?P<sign>[-+ ])?z?(?P<alt>#)?(?P<zero>0)?\d*"
+    r"(?P<grouping>[,_])?(?:\.\d+)?(?P<type>[bcdoxXneEfFgG%])?$"
+)
+
+
+class FieldFormatter(string.Formatter):
+    """Format hash fields, which are all strings
+
+    A field is converted to a number only when the format spec
+    needs one, such as {sequence_number:04} or {x:.2f}, so that
+    {uid} keeps leading zeros.
+    """
+
+    def format_field(self, value, format_spec):
+        if isinstance(value, str) and self.numeric(format_spec):
+            for number in (int, float):
+                try:
+                    value = number(value)
+                    break
+                except ValueError:
+                    pass
+        return super().format_field(value, format_spec)
+
+    @staticmethod
+    def numeric(format_spec):
+        spec = FORMAT_SPEC.match(format_spec)
+        if spec is None:
+            return False
+        return bool(
+            spec.group("sign")
+            or spec.group("alt")
+            or spec.group("grouping")
+            or spec.group("type")
+            or spec.group("align") == "="
+            or (spec.group("zero") and not spec.group("align"))
+        )
+
+
+class BlobReader(io.RawIOBase):
+    """Readable file object that streams a blob in chunks"""
+
+    def __init__(self, binary_r, key):
+        self.chunks = iter_blob(binary_r, key)
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            try:
+                self.buffer = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
 
 
 class keli_src(object):
@@ -23,60 +96,253 @@ class keli_src(object):
             host=r_ip, port=r_port, decode_responses=True
         )
 
-    def src_ruling_str(self, context, ruling_string, *args):
-        db_item = self.redis_conn.hgetall(context["uuid"])
-        rulings = ruling.rule_offline(ruling_string, glworb_dict=db_item)
-        db_item.update(**rulings)
-        self.redis_conn.hmset(context["uuid"], db_item)
+    def _glworbs(self, pattern, structured_sequence=None):
+        # a structured sequence list, a scan pattern or a single key
+        if structured_sequence is not None:
+            return self.redis_conn.lrange(structured_sequence, 0, -1)
+        if any(c in pattern for c in "*?["):
+            return list(self.redis_conn.scan_iter(match=pattern))
+        return [pattern]
+
+    def src_ruling_str(
+        self, context, ruling_string, structured_sequence=None, chunk_size=100, *args
+    ):
+        # context["uuid"] may be a single hash, a pattern such as
+        # glworb:* or ignored when structured_sequence is used
+        glworbs = self._glworbs(context["uuid"], structured_sequence)
+        chunk_size = int(chunk_size)
+        changed_fields = 0
+        changed_hashes = 0
+        for start in range(0, len(glworbs), chunk_size):
+            chunk = glworbs[start : start + chunk_size]
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for glworb in chunk:
+                pipe.hgetall(glworb)
+            db_items = pipe.execute()
+
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for glworb, db_item in zip(chunk, db_items):
+                rulings = ruling.rule_offline(ruling_string, glworb_dict=db_item)
+                # only write fields whose value changes
+                changed = {k: v for k, v in rulings.items() if db_item.get(k) != str(v)}
+                if changed:
+                    pipe.hmset(glworb, changed)
+                    changed_fields += len(changed)
+                    changed_hashes += 1
+            pipe.execute()
+
+        print(
+            "{} fields changed in {} of {} hashes".format(
+                changed_fields, changed_hashes, len(glworbs)
+            )
+        )
+        context["changed_fields"] = changed_fields
         return context
 
     def src_artifact(self, context, filename, path="", *args):
         bytes_key = self.redis_conn.hget(context["uuid"], context["key"])
-        artifact_bytes = self.binary_r.get(bytes_key)
         file_path = pathlib.Path(path, filename).expanduser().absolute()
         dir_path = pathlib.Path(path).expanduser().absolute()
-        if not dir_path.is_dir():
-            os.mkdir(dir_path)
-        with open(file_path, "wb+") as file:
-            file.write(artifact_bytes)
+        os.makedirs(str(dir_path), exist_ok=True)
+        blob_to_file(self.binary_r, bytes_key, file_path)
+
+    def src_artifact_bulk(
+        self,
+        context,
+        template,
+        path="",
+        structured_sequence=None,
+        archive=None,
+        workers=4,
+        *args
+    ):
+        """Export many blobs to a directory or an archive
+
+            Args:
+                context(dict): dictionary of context info,
+                    context["uuid"] is a pattern such as glworb:*
+                    and context["key"] the field of the blob
+                template(str): filename formatted with the hash
+                    fields, for example {sequence_number:04}.jpg
+                path(str): directory to write to
+                structured_sequence(str): list of glworbs to use
+                    instead of the pattern
+                archive(str): tar, tar.gz or zip file to write
+                    into instead of a directory
+                workers(int): parallel writers for directories
+                *args:
+        """
+        glworbs = self._glworbs(context["uuid"], structured_sequence)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for glworb in glworbs:
+            pipe.hgetall(glworb)
+        artifacts = []
+        # glworbs missing a field of the template are skipped
+        skipped = []
+        for glworb, fields in zip(glworbs, pipe.execute()):
+            if context["key"] not in fields:
+                continue
+            fields["glworb"] = glworb
+            try:
+                filename = FieldFormatter().vformat(template, (), fields)
+            except KeyError as ex:
+                skipped.append((glworb, ex.args[0]))
+                continue
+            artifacts.append((fields[context["key"]], filename))
+
+        start = time.perf_counter()
+        if archive is not None:
+            written = self._artifacts_to_archive(artifacts, archive)
+        else:
+            dir_path = pathlib.Path(path).expanduser().absolute()
+
+            def export(artifact):
+                bytes_key, filename = artifact
+                file_path = pathlib.Path(dir_path, filename)
+                os.makedirs(str(file_path.parent), exist_ok=True)
+                return blob_to_file(self.binary_r, bytes_key, file_path)
+
+            with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+                written = sum(pool.map(export, artifacts))
+
+        elapsed = time.perf_counter() - start
+        print(
+            "exported {} files, {} bytes in {:.2f}s ({:.2f} MB/s)".format(
+                len(artifacts),
+                written,
+                elapsed,
+                written / elapsed / 1024 / 1024 if elapsed else 0,
+            )
+        )
+        if skipped:
+            print(
+                "skipped {} without template fields: {}".format(
+                    len(skipped),
+                    ", ".join("{} ({})".format(g, field) for g, field in skipped),
+                )
+            )
+        context["exported"] = len(artifacts)
+        context["exported_bytes"] = written
+        context["skipped"] = [glworb for glworb, _ in skipped]
+        return context
+
+    def _artifacts_to_archive(self, artifacts, archive):
+        archive = str(pathlib.Path(archive).expanduser().absolute())
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        written = 0
+        if archive.endswith(".zip"):
+            with zipfile.ZipFile(archive, "w") as zf:
+                for bytes_key, filename in artifacts:
+                    with zf.open(filename, "w") as member:
+                        for chunk in iter_blob(self.binary_r, bytes_key):
+                            written += member.write(chunk)
+        else:
+            mode = "w:gz" if archive.endswith(("gz", "tgz")) else "w"
+            with tarfile.open(archive, mode) as tf:
+                for bytes_key, filename in artifacts:
+                    info = tarfile.TarInfo(filename)
+                    info.size = self.binary_r.strlen(bytes_key)
+                    info.mtime = time.time()
+                    tf.addfile(info, BlobReader(self.binary_r, bytes_key))
+                    written += info.size
+        return written
+
+    def _sequence_position(self, structured_sequence, item):
+        """Position of item in a structured sequence list
+
+            Uses a uuid to position hash for the sequence that
+            is checked with LINDEX and rebuilt when stale,
+            instead of fetching the whole list.
+        """
+        index_key = SEQUENCE_INDEX_TEMPLATE.format(structured_sequence)
+        position = self.redis_conn.hget(index_key, item)
+        if position is not None:
+            position = int(position)
+            if self.redis_conn.lindex(structured_sequence, position) == item:
+                return position
+        positions = self._index_sequence(structured_sequence)
+        try:
+            return positions[item]
+        except KeyError:
+            raise ValueError("{} is not in {}".format(item, structured_sequence))
+
+    def _index_sequence(self, structured_sequence, chunk_size=1000):
+        # rebuild the position hash, first occurrence wins
+        # to match list.index
+        structured = self.redis_conn.lrange(structured_sequence, 0, -1)
+        positions = {}
+        for position, item in enumerate(structured):
+            positions.setdefault(item, position)
+        index_key = SEQUENCE_INDEX_TEMPLATE.format(structured_sequence)
+        pipe = self.redis_conn.pipeline()
+        pipe.delete(index_key)
+        items = list(positions.items())
+        for start in range(0, len(items), chunk_size):
+            pipe.hmset(index_key, dict(items[start : start + chunk_size]))
+        pipe.execute()
+        return positions
+
+    def _sequence_range(self, structured_sequence, start, stop):
+        # items in [start, stop) using only that slice of the list,
+        # a negative start counts from the end as list slicing does
+        if start < 0:
+            start = max(start + self.redis_conn.llen(structured_sequence), 0)
+        if stop <= start:
+            return []
+        return self.redis_conn.lrange(structured_sequence, start, stop - 1)
+
+    def _numerate(self, field, numbered):
+        # set field for (item, number) pairs in one round trip
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for item, number in numbered:
+            pipe.hset(item, field, number)
+        pipe.execute()
 
     def src_numerate_to_zero(
         self, context, structured_sequence, start_at=None, end_at=None, step=1, *args
     ):
         # accept either list or db key to list for structured_sequence
         # if start_at is None, try to use key/field value and decrement
-        structured = self.redis_conn.lrange(structured_sequence, 0, -1)
-        starting_position = structured.index(context["uuid"])
+        starting_position = self._sequence_position(
+            structured_sequence, context["uuid"]
+        )
         if start_at is None:
             starting_value = int(self.redis_conn.hget(context["uuid"], context["key"]))
         else:
             starting_value = int(start_at)
-        to_numerate = structured[
-            starting_position - (starting_value) : starting_position
-        ][::-1]
-        for source_num, source in enumerate(to_numerate):
-            # print(starting_value - source_num -1, self.redis_conn.hget(source, context["key"]))
-            self.redis_conn.hset(
-                source, context["key"], (starting_value - source_num - 1)
-            )
+        to_numerate = self._sequence_range(
+            structured_sequence, starting_position - (starting_value), starting_position
+        )[::-1]
+        self._numerate(
+            context["key"],
+            (
+                (source, starting_value - source_num - 1)
+                for source_num, source in enumerate(to_numerate)
+            ),
+        )
 
     def src_numerate_to_one(
         self, context, structured_sequence, start_at=None, end_at=None, step=1, *args
     ):
-        structured = self.redis_conn.lrange(structured_sequence, 0, -1)
-        starting_position = structured.index(context["uuid"])
+        starting_position = self._sequence_position(
+            structured_sequence, context["uuid"]
+        )
         if start_at is None:
             starting_value = int(self.redis_conn.hget(context["uuid"], context["key"]))
         else:
             starting_value = int(start_at)
-        to_numerate = structured[
-            starting_position - (starting_value - 1) : starting_position
-        ][::-1]
-        for source_num, source in enumerate(to_numerate):
-            # print(starting_value - source_num -1, self.redis_conn.hget(source, context["key"]), source)
-            self.redis_conn.hset(
-                source, context["key"], (starting_value - source_num - 1)
-            )
+        to_numerate = self._sequence_range(
+            structured_sequence,
+            starting_position - (starting_value - 1),
+            starting_position,
+        )[::-1]
+        self._numerate(
+            context["key"],
+            (
+                (source, starting_value - source_num - 1)
+                for source_num, source in enumerate(to_numerate)
+            ),
+        )
 
     def src_numerate_to(
         self, context, structured_sequence, start_at=None, end_at=None, step=1, *args
@@ -84,28 +350,30 @@ class keli_src(object):
         # add 1 to be inclusive:
         if end_at >= 0:
             end_at += 1
-        structured = self.redis_conn.lrange(structured_sequence, 0, -1)
-        starting_position = structured.index(context["uuid"])
+        starting_position = self._sequence_position(
+            structured_sequence, context["uuid"]
+        )
         if start_at is None:
             starting_value = int(self.redis_conn.hget(context["uuid"], context["key"]))
         else:
             starting_value = int(start_at)
         if end_at > starting_value:
             direction = 1
-            to_numerate = structured[
-                starting_position : starting_position + (end_at - starting_value)
-            ]
+            to_numerate = self._sequence_range(
+                structured_sequence,
+                starting_position,
+                starting_position + (end_at - starting_value),
+            )
         else:
             direction = -1
             if end_at < 0:
                 end_at = abs(end_at)
-            to_numerate = structured[starting_position - (end_at) : starting_position][
-                ::-1
-            ]
+            to_numerate = self._sequence_range(
+                structured_sequence, starting_position - (end_at), starting_position
+            )[::-1]
+        numbered = []
         for source_num, source in enumerate(to_numerate):
             if direction < 1:
                 source_num += 1
-            # print((starting_value + (source_num * direction)), self.redis_conn.hget(source, context["key"]), source)
-            self.redis_conn.hset(
-                source, context["key"], (starting_value + (source_num * direction))
-            )
+            numbered.append((source, starting_value + (source_num * direction)))
+        self._numerate(context["key"], numbered)
@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import atexit
+import threading
+import collections
+from contextlib import contextmanager
+from tesserocr import PyTessBaseAPI, PSM, OEM
+
+
+class TesseractPool(object):
+    """Process-wide pool of initialized tesseract engines
+
+    Engines are keyed by (lang, psm, oem) so that model loading
+    happens once per key instead of once per call. At most size
+    engines are created for each key, borrowers wait for a free
+    engine once that limit is reached.
+
+    The default size can be set with KELI_TESSERACT_POOL_SIZE.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = int(os.environ.get("KELI_TESSERACT_POOL_SIZE", os.cpu_count() or 1))
+        self.size = size
+        self.idle = collections.defaultdict(list)
+        self.created = collections.Counter()
+        self.available = threading.Condition()
+
+    @contextmanager
+    def borrow(self, lang="eng", psm=PSM.AUTO, oem=OEM.DEFAULT):
+        key = (lang, psm, oem)
+        api = None
+        with self.available:
+            while not self.idle[key] and self.created[key] >= self.size:
+                self.available.wait()
+            if self.idle[key]:
+                api = self.idle[key].pop()
+            else:
+                self.created[key] += 1
+        if api is None:
+            try:
+                api = PyTessBaseAPI(lang=lang, psm=psm, oem=oem)
+            except Exception:
+                with self.available:
+                    self.created[key] -= 1
+                    self.available.notify()
+                raise
+        try:
+            yield api
+        finally:
+            # release the image and results but keep the models loaded
+            api.Clear()
+            with self.available:
+                self.idle[key].append(api)
+                self.available.notify()
+
+    def close(self):
+        with self.available:
+            for key, engines in self.idle.items():
+                for api in engines:
+                    api.End()
+                self.created[key] -= len(engines)
+                engines.clear()
+
+
+tesseract_pool = TesseractPool()
+atexit.register(tesseract_pool.close)